@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Batch runner: main.py pipeline over a directory or glob of WAV recordings,
+in parallel and headless, with one results table for the whole run.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+# IMPORTS
+import os
+os.environ.setdefault("MPLBACKEND", "Agg")  # Headless, also in the worker processes
+
+import csv
+import glob
+import contextlib
+import multiprocessing
+from time import perf_counter
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import demlib as dm
+import main as pipeline
+
+FIELDS = ["file", "status", "pings", "msg", "t_process", "t_threshold", "t_detect", "t_total", "error"]
+
+
+#######################################################
+# FILES
+#######################################################
+
+def list_files(source):
+
+    """
+    WAV files to process
+
+    Parameters:
+    source (str): directory (all its .wav files) or glob pattern
+
+    Returns:
+    files (list): sorted absolute paths
+    """
+
+    if os.path.isdir(source):
+        pattern = os.path.join(source, "*.[wW][aA][vV]")
+    else:
+        pattern = source
+
+    return sorted(os.path.abspath(f) for f in glob.glob(pattern, recursive=True) if os.path.isfile(f))
+
+
+def read_rows(table):
+
+    """
+    Last row of each file in a results table, a file run again (resume,
+    retry) appends a newer row
+
+    Returns:
+    rows (dict): file -> row, in order of first appearance
+    """
+
+    if not os.path.exists(table):
+        return {}
+
+    rows = {}
+    with open(table, newline="") as f:
+        for row in csv.DictReader(f):
+            rows[row["file"]] = row
+
+    return rows
+
+
+def read_done(table):
+
+    """
+    Files already processed in a results table, to resume a run
+    """
+
+    return {file for file, row in read_rows(table).items() if row["status"] == "ok"}
+
+
+def compact_table(table):
+
+    """
+    Rewrite a results table with only the last row of each file
+    """
+
+    rows = read_rows(table)
+    with open(table + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows.values())
+    os.replace(table + ".tmp", table)
+
+
+#######################################################
+# WORKER
+#######################################################
+
+def run_file(file, args, store=None):
+
+    """
+    Run the pipeline on one file, errors are returned in the row
+    """
+
+    row = dict.fromkeys(FIELDS, "")
+    row["file"] = file
+    timings = {}
+    profiler = dm.Profiler(args.profileMemory) if args.profile else None
+
+    t0 = perf_counter()
+    try:
+        args.input = file
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+            pings, msg = pipeline.main(args, timings, profiler or dm.NULL_PROFILER, store)
+
+        row["status"] = "ok"
+        row["pings"] = pings
+        row["msg"] = " ".join(str(m) for m in msg) if isinstance(msg, list) else msg
+
+    except Exception as e:
+        row["status"] = "error"
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    for stage in ("process", "threshold", "detect"):
+        if stage in timings:
+            row[f"t_{stage}"] = f"{timings[stage]:.6f}"
+    row["t_total"] = f"{perf_counter() - t0:.6f}"
+
+    # Stage profile of the file, merged by run_batch and not written to the table
+    if profiler:
+        row["profile"] = profiler.report()
+
+    return row
+
+
+_started = None  # Shared flag per task of the pool round, set by the worker that takes it
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def run_chunk(files, args, task=None):
+    if task is not None:
+        _started[task] = 1
+
+    # One results store writer per chunk, its rows written in batches
+    if not args.store:
+        return [run_file(file, args) for file in files]
+
+    with dm.ResultStore(args.store) as store:
+        return [run_file(file, args, store) for file in files]
+
+
+#######################################################
+# BATCH
+#######################################################
+
+def run_batch(files, args, table, workers=None, chunk=1, retries=1, profiler=None):
+
+    """
+    Process the files over a process pool, appending one row per file
+
+    Each row is written as soon as its chunk ends, so a stopped run keeps
+    what it did. A worker that dies breaks the whole pool: the chunks that
+    had not started go to a fresh pool, still in parallel, and only the
+    files of the chunks that were running are run again one by one in
+    their own process, up to `retries` times, before they are written as
+    "crashed". At the end the table keeps only the last row of each file,
+    the rows of a file run again (resume, earlier error) are replaced.
+
+    Parameters:
+    files (list): paths to process
+    args (Namespace): main.py arguments, the input is replaced per file
+    table (str): results CSV, created if missing
+    workers (int): processes, default all cores
+    chunk (int): files per task
+    retries (int): isolated attempts of a file running in a crash
+    profiler (Profiler): stage profiles of all the files, if args.profile
+
+    Returns:
+    status (dict): number of files per status
+    """
+
+    args.show = 0
+    args.output = 0
+
+    chunks = [files[i:i + chunk] for i in range(0, len(files), chunk)]
+    lost = []
+    status = {}
+
+    new_table = not os.path.exists(table)
+    with open(table, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_table:
+            writer.writeheader()
+
+        def write(row):
+            report = row.pop("profile", None)
+            if report and profiler:
+                profiler.merge(report)
+            writer.writerow(row)
+            f.flush()
+            status[row["status"]] = status.get(row["status"], 0) + 1
+
+        # Pool rounds until no chunk is left, a round ends early when the pool breaks
+        tasks = chunks
+        while tasks:
+            started = multiprocessing.RawArray("b", len(tasks))
+            left = []
+
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(started,)) as pool:
+                futures = {pool.submit(run_chunk, files_chunk, args, i): i for i, files_chunk in enumerate(tasks)}
+
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        rows = future.result()
+                    except BrokenProcessPool:
+                        if started[i]:
+                            lost += tasks[i]
+                        else:
+                            left.append(tasks[i])
+                        continue
+
+                    for row in rows:
+                        write(row)
+
+            # A worker that died before taking its task: no culprit, isolate them all
+            if left and len(left) == len(tasks):
+                lost += [file for files_chunk in left for file in files_chunk]
+                left = []
+            tasks = left
+
+        # Isolate the files running in a crash, a crash only takes its own file
+        for file in lost:
+            row = {**dict.fromkeys(FIELDS, ""), "file": file, "status": "crashed", "error": "worker process died"}
+            for _ in range(retries):
+                try:
+                    with ProcessPoolExecutor(1) as pool:
+                        row = pool.submit(run_file, file, args).result()
+                    break
+                except BrokenProcessPool:
+                    pass
+
+            write(row)
+
+    compact_table(table)
+
+    return status
+
+
+# MAIN
+
+def main(args):
+    files = list_files(args.input)
+    print(f"Input: {args.input}, {len(files)} files")
+
+    if args.resume:
+        done = read_done(args.table)
+        files = [file for file in files if file not in done]
+        print(f"Resume: {len(done)} files already in {args.table}")
+
+    # Stages of every file together, one process per worker in the trace. The
+    # workers measure the memory, the merge does not need tracemalloc
+    profiler = dm.Profiler() if args.profile else None
+
+    t0 = perf_counter()
+    status = run_batch(files, args, args.table, args.workers or None, args.chunk, args.retries, profiler)
+
+    print(f"{len(files)} files in {perf_counter() - t0:.1f} s: {status}")
+    print(f"Results: {args.table}")
+
+    if profiler:
+        print(profiler.summary())
+        print("Profile: " + ", ".join(profiler.save(args.profile)))
+
+    return status
+
+
+if __name__ == "__main__":
+
+    # INIT, same options as main.py
+    argparser = ArgumentParser(parents=[pipeline.build_argparser()], conflict_handler="resolve")
+
+    # INPUT
+    argparser.add_argument("-i", "--input", help="Directory of WAV files or glob pattern, default docs", type=str, default="docs")
+
+    # BATCH
+    argparser.add_argument("-w", "--workers", help="Worker processes, 0 all cores, default 0", type=int, default=0)
+    argparser.add_argument("-ch", "--chunk", help="Files per worker task, default 1", type=int, default=1)
+    argparser.add_argument("-rt", "--retries", help="Isolated attempts of a file running in a worker crash, default 1", type=int, default=1)
+    argparser.add_argument("-t", "--table", help="Results table, default docs/batch_results.csv", type=str, default="docs/batch_results.csv")
+    argparser.add_argument("-rs", "--resume", help="Skip the files already in the results table", action="store_true")
+
+    # EXIT
+    args = argparser.parse_args()
+
+    try:
+        main(args)
+
+    except KeyboardInterrupt:
+        print("Program terminated by user.")
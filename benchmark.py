@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Detectability benchmark: synthetic PPM recordings at controlled SNR, noise
+and multipath through each processing method, CFAR and decode. Reports the
+pulse detection probability, false alarms, message decode rate, run time
+per second of audio and peak memory, reproducible by seed.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+# IMPORTS
+import csv
+import tracemalloc
+from time import perf_counter
+from argparse import ArgumentParser
+
+import numpy as np
+
+import demlib as dm
+from docs.filter_coefficients import coefficients_antialiassing, coefficients_bandpass
+from docs.decode_lists import dict_vemco
+
+METHODS = {1: "FFT", 2: "GOERTZEL", 3: "FILTERING", 4: "SLIDING GOERTZEL"}
+FIELDS = ["method", "snr_db", "noise", "trials", "pd", "false_alarms_s", "msg_ok", "time_per_s", "peak_mb",
+          "mcu_load", "mcu_uj_s", "detections_uj"]
+
+
+#######################################################
+# PIPELINE
+#######################################################
+
+def detect_times(samples, sample_rate, method, args):
+
+    """
+    main.py pipeline on a recording in memory
+
+    Returns:
+    detect_times (list): pulse end times
+    decoded (list or str): decoded msg
+    """
+
+    down, _ = dm.do_downsample_float(samples, args.sampleRate, sample_rate / args.sampleRate)
+
+    if method == 4:
+        res = dm.do_sdft(down, args.sampleRate, args.goertzel, args.buffer, args.hop)[0].max(axis=1)
+        step = args.hop
+    else:
+        buffers, _ = dm.do_buffers(down, args.buffer, args.sampleRate)
+        step = args.buffer
+
+        if method == 1:
+            res = dm.do_fft(buffers, args.sampleRate, args.onFreq, args.offFreq, fmt=args.numeric)[0]
+        elif method == 2:
+            res = dm.do_goertzel(buffers, args.sampleRate, args.goertzel, fmt=args.numeric).max(axis=1)
+        else:
+            res = dm.do_filter(buffers, args.sampleRate, args.filterFrequency, args.localOscillator,
+                               coefficients_antialiassing, coefficients_bandpass, fmt=args.numeric)
+
+    cells = args.buffer*10*args.buffer//step
+    _, detect = dm.do_cfar_adapt(dm.normalize_0_1(res), args.sampleRate, step, args.pulseWidth, cells)
+    _, times = dm.do_check_pulse(detect, args.sampleRate, step, args.pulseWidth)
+    _, decoded = dm.decode_times(times, 0.339, dict_vemco)
+
+    return times, decoded
+
+
+def _nearest(a, b):
+    # Distance of each value of a to the closest of b (sorted)
+    i = np.searchsorted(b, a)
+    left = np.abs(a - b[np.clip(i - 1, 0, len(b) - 1)])
+    right = np.abs(b[np.clip(i, 0, len(b) - 1)] - a)
+    return np.minimum(left, right)
+
+
+def score(ends, times, tolerance):
+
+    """
+    Match the detected pulse ends with the true ones
+
+    Returns:
+    hits (int): true pulses with a detection closer than the tolerance
+    false_alarms (int): detections far from every true pulse
+    """
+
+    ends = np.asarray(ends)
+    times = np.asarray(times)
+    if len(times) == 0 or len(ends) == 0:
+        return 0, len(times)
+
+    hits = int(np.sum(_nearest(ends, times) <= tolerance))
+    false_alarms = int(np.sum(_nearest(times, ends) > tolerance))
+
+    return hits, false_alarms
+
+
+def mcu_cost(method, args):
+
+    """
+    Estimated STM32L432 cost of the pipeline per second of signal
+    """
+
+    return dm.pipeline_cost(method, args.sampleRate, args.buffer, args.pulseWidth, hop=args.hop,
+                            n_freqs=len(args.goertzel), onFreq=args.onFreq, offFreq=args.offFreq,
+                            frequency=args.filterFrequency, f_lo=args.localOscillator,
+                            taps=(len(coefficients_antialiassing), len(coefficients_bandpass)))
+
+
+#######################################################
+# BENCHMARK
+#######################################################
+
+def run_benchmark(args):
+
+    """
+    Every method over every SNR and noise type, `args.trials` recordings each
+
+    Returns:
+    rows (list of dict): one per method, SNR and noise type
+    """
+
+    multipath = [tuple(float(v) for v in path.split(":")) for path in args.multipath]
+    rows = []
+
+    for n_noise, noise in enumerate(args.noise):
+        for n_snr, snr in enumerate(args.snr):
+            stats = {method: dict(hits=0, pulses=0, false_alarms=0, msg_ok=0, time=0, peak=0) for method in args.methods}
+
+            for trial in range(args.trials):
+                # Same recording for every method
+                seed = np.random.SeedSequence([args.seed, n_noise, n_snr, trial])
+                ends = dm.ppm_train(args.message, dict_vemco, args.duration)
+                samples = dm.synth_ppm(args.wavRate, ends, snr, args.duration, args.carrier, args.pulseWidth,
+                                       noise, multipath, seed=seed)
+                expected = (["init"] + args.message) * (len(ends) // (len(args.message) + 1))
+
+                for method in args.methods:
+                    s = stats[method]
+
+                    t0 = perf_counter()
+                    times, decoded = detect_times(samples, args.wavRate, method, args)
+                    s["time"] += perf_counter() - t0
+
+                    # Memory on the first recording, tracemalloc slows the run
+                    if trial == 0 and args.memory:
+                        tracemalloc.start()
+                        detect_times(samples, args.wavRate, method, args)
+                        s["peak"] = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+
+                    hits, false_alarms = score(ends, times, args.matchTolerance/1000)
+                    s["hits"] += hits
+                    s["pulses"] += len(ends)
+                    s["false_alarms"] += false_alarms
+                    s["msg_ok"] += decoded == expected
+
+            audio = args.trials * args.duration
+            for method in args.methods:
+                s = stats[method]
+                mcu = mcu_cost(method, args)
+                rows.append({
+                    "method": METHODS[method],
+                    "snr_db": snr,
+                    "noise": noise,
+                    "trials": args.trials,
+                    "pd": s["hits"] / s["pulses"],
+                    "false_alarms_s": s["false_alarms"] / audio,
+                    "msg_ok": s["msg_ok"] / args.trials,
+                    "time_per_s": s["time"] / audio,
+                    "peak_mb": s["peak"] / 2**20,
+                    "mcu_load": mcu["load"],
+                    "mcu_uj_s": mcu["uj_s"],
+                    "detections_uj": s["hits"] / (mcu["uj_s"] * audio),
+                })
+
+    return rows
+
+
+def print_rows(rows):
+    print(f"{'method':<17}{'SNR dB':>7} {'noise':<10}{'Pd':>6}{'FA/s':>7}{'msg ok':>7}{'s/s audio':>10}{'peak MB':>9}"
+          f"{'MCU load':>9}{'uJ/s':>9}{'det/uJ':>9}")
+    for r in rows:
+        print(f"{r['method']:<17}{r['snr_db']:>7} {r['noise']:<10}{r['pd']:>6.2f}{r['false_alarms_s']:>7.2f}"
+              f"{r['msg_ok']:>7.2f}{r['time_per_s']:>10.4f}{r['peak_mb']:>9.1f}"
+              f"{r['mcu_load']:>9.3f}{r['mcu_uj_s']:>9.0f}{r['detections_uj']:>9.2e}")
+
+
+def rank_methods(rows):
+
+    """
+    Methods by detections per uJ over all the SNR and noise types
+
+    Returns:
+    ranking (list): (method, detections per uJ), best first
+    """
+
+    ranking = {}
+    for r in rows:
+        ranking.setdefault(r["method"], []).append(r["detections_uj"])
+
+    return sorted(((method, sum(v) / len(v)) for method, v in ranking.items()), key=lambda m: -m[1])
+
+
+# MAIN
+
+def main(args):
+    rows = run_benchmark(args)
+    print_rows(rows)
+
+    print("\nRanking, detections per uJ on the MCU:")
+    for i, (method, detections_uj) in enumerate(rank_methods(rows)):
+        print(f"{i + 1}. {method:<17}{detections_uj:.2e}")
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Results: {args.output}")
+
+    return rows
+
+
+if __name__ == "__main__":
+
+    # INIT
+    argparser = ArgumentParser()
+
+    # SYNTHETIC SIGNAL
+    argparser.add_argument("-wr", "--wavRate", help="Sample rate of the synthetic recordings, default 500000 S/s", type=int, default=500000)
+    argparser.add_argument("-d", "--duration", help="Recording length in s, default 12", type=float, default=12)
+    argparser.add_argument("-msg", "--message", help="Symbols after the init pulse, default 355 495 415 455 595 495", type=int, nargs="+", default=[355, 495, 415, 455, 595, 495])
+    argparser.add_argument("-cr", "--carrier", help="Pulse frequency, default 69000 Hz", type=int, default=69000)
+    argparser.add_argument("-snr", "--snr", help="Pulse SNR in the full band in dB, default -20 -15 -10 -5 0", type=float, nargs="+", default=[-20, -15, -10, -5, 0])
+    argparser.add_argument("-nt", "--noise", help="Noise types, white, pink, impulsive, default white", type=str, nargs="+", choices=dm.NOISE_TYPES, default=["white"])
+    argparser.add_argument("-mp", "--multipath", help="Echoes as delay_s:gain, e.g. 0.002:0.5, default none", type=str, nargs="*", default=[])
+    argparser.add_argument("-t", "--trials", help="Recordings per SNR and noise type, default 3", type=int, default=3)
+    argparser.add_argument("-s", "--seed", help="Random seed, default 0", type=int, default=0)
+
+    # ACQUISITION AND METHODS, as main.py
+    argparser.add_argument("-sr", "--sampleRate", help="Sample Rate of the uC, default 150000 S/s", type=int, default=150000)
+    argparser.add_argument("-b", "--buffer", help="ADC Buffer lenght, default = 256", type=int, default=256)
+    argparser.add_argument("-m", "--methods", help="Processing methods, 1: FFT, 2: Go, 3: Filt, 4: Sliding Go, default all", type=int, nargs="+", choices=list(METHODS), default=list(METHODS))
+    argparser.add_argument("-nf", "--numeric", help="Numeric format of methods 1-3, float64, float32, q15 or q31, default float64", type=str, choices=dm.FORMATS, default="float64")
+    argparser.add_argument("-hop", "--hop", help="Sliding Goertzel hop in samples, default = 64", type=int, default=64)
+    argparser.add_argument("-g", "--goertzel", help="Goertzel center frequency, default = 69000", type=int, nargs="+", default=[69000])
+    argparser.add_argument("-on", "--onFreq", help="Bandpass on frequency in Hz, default 68000 Hz", type=int, default=68000)
+    argparser.add_argument("-off", "--offFreq", help="Bandpass off frequency in Hz, default 70000 Hz", type=int, default=70000)
+    argparser.add_argument("-ffreq", "--filterFrequency", help="center signal frequency", type=int, default=69000)
+    argparser.add_argument("-LO", "--localOscillator", help="Local Oscillator, default 58000", type=int, default=58000)
+    argparser.add_argument("-p", "--pulseWidth", help="Pulse Width, default 5 ms", type=int, default=5)
+
+    # SCORING AND OUTPUT
+    argparser.add_argument("-mt", "--matchTolerance", help="Max distance of a detection to a true pulse end, default 10 ms", type=float, default=10)
+    argparser.add_argument("-mem", "--memory", help="Measure the peak memory, 1 yes 0 no, default 1", type=int, default=1)
+    argparser.add_argument("-o", "--output", help="Results CSV, default none", type=str, default="")
+
+    # EXIT
+    args = argparser.parse_args()
+
+    try:
+        main(args)
+
+    except KeyboardInterrupt:
+        print("Program terminated by user.")
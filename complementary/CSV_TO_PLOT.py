@@ -1,15 +1,13 @@
 # IMPORTS
+import os
+import sys
 from argparse import ArgumentParser
 
-import pandas as pd
-import pyarrow
-
 import numpy as np
 import matplotlib.pyplot as plt
 
-plt.rcParams.update({
-    "text.usetex": True
-})
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import demlib as dm  # CSV captures streamed with pyarrow into a memory-mapped cache
 
 #MAIN
 if __name__ == "__main__":
@@ -20,19 +18,23 @@ if __name__ == "__main__":
     argparser.add_argument("-i", "--input", help="Input file directory and name, default csv/analog.csv", type=str, default="csv/analog.csv")
     argparser.add_argument("-x", "--xdata", help="Input column name for x, default Time(s)", type=str, default="Time(s)")
     argparser.add_argument("-y", "--ydata", help="Input column name for y default Data", type=str, default="Data")
+    argparser.add_argument("-r", "--rate", help="Sample rate, default from the x column", type=float, default=None)
+    argparser.add_argument("-ca", "--cache", help="Binary cache folder, default .capture_cache next to the CSV", type=str, default=None)
+    argparser.add_argument("-tex", "--latex", help="LaTeX text (slower, needs LaTeX), 1 yes 0 no, default 0", type=int, default=0)
 
     args = argparser.parse_args()
 
 
-    # CSV READ
-    df = pd.read_csv(args.input)
+    # CSV READ, converted on the first open, memory-mapped afterwards
+    sample_rate, data = dm.open_csv(args.input, args.ydata, args.xdata, args.rate, args.cache)
 
-   # time = df[args.xdata]
-    data = df[args.ydata]
+    if args.verbose:
+        print(f"{len(data)} samples at {sample_rate} S/s")
 
-    #FIGURE
+    #FIGURE, min/max envelope of the capture redrawn on zoom
+    dm.use_latex(args.latex)
     fig, ax = plt.subplots()
 
-    ax.plot(data)
+    plots = dm.plot_envelope(ax, data, 0, 1 / sample_rate)
 
     plt.show()
\ No newline at end of file
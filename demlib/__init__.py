@@ -1,10 +1,70 @@
 # __init__.py
 
-# Core library file
-from .core import *
+# The submodules are imported on the first use of one of their names, so
+# `import demlib` stays cheap and a run only loads what it calls. The names
+# are those each submodule defines, listed below: a name listed twice comes
+# from the last submodule, as the star imports it replaces. Names a
+# submodule only imports (np, time, ...) are not exported, import them
+# directly. tests/test_exports.py checks the table against the submodules.
 
-# Utility side files
-from .utils import *
+from importlib import import_module as _import_module
 
-# Development tests
-from .indev import *
\ No newline at end of file
+_EXPORTS = {
+    # Core library file
+    "core": ("read_wav", "open_wav", "iter_blocks", "time_axis", "do_downsample_float", "do_downsample_blocks",
+             "do_buffers", "do_buffers_blocks", "mix_downconvert", "filter_antialiassing", "do_filter", "do_fft",
+             "do_goertzel", "do_sdft", "do_sdft_blocks", "do_cfar", "do_check_pulse", "fuse_times", "Decoder",
+             "decode_times"),
+    # Numeric formats
+    "fixed": ("FORMATS", "frac_bits", "saturate", "quantize", "dequantize", "round_shift", "to_format"),
+    # Utility side files
+    "utils": ("normalize_0_1", "normalize_neg1_1", "normalize_custom", "do_downsample_integer"),
+    # Streaming pipeline
+    "stream": ("NormalizeStage", "RunningNormalizeStage", "CfarStage", "PulseStage", "DecodeStage", "FusionStage",
+               "StreamEngine", "ArrayEngine"),
+    # On-disk array cache
+    "cache": ("code_version", "array_hash", "ArrayCache"),
+    # MCU cost model
+    "cost": ("COST_TABLE", "OPS", "FLOAT_BYTES", "count_fft", "count_goertzel", "count_filter", "count_sdft",
+             "count_cfar", "count_pulse", "total", "cost", "pipeline_cost"),
+    # Synthetic recordings
+    "synth": ("NOISE_TYPES", "ppm_train", "synth_ppm"),
+    # Parameter sweep
+    "sweep": ("SWEEP_DEFAULTS", "STAGES", "DISK_STAGES", "UPSTREAM", "expand_grid", "stage_keys", "method_key",
+              "StageCache", "run_sweep"),
+    # Live detector
+    "live": ("SharedRing", "FileSource", "SocketSource", "RingSource", "ChannelSource", "open_source",
+             "LiveDetector"),
+    # Stage profiling
+    "profiling": ("FIELDS", "NullProfiler", "NULL_PROFILER", "Profiler"),
+    # Parquet results store
+    "results": ("SCHEMAS", "PARTITIONS", "recording_start", "config_hash", "symbol_times", "correlation_peaks",
+                "ResultStore"),
+    # Logic-analyzer captures
+    "capture": ("capture_cache", "convert_csv", "open_csv"),
+    # Envelope plots of long recordings
+    "plotting": ("envelope_pyramid", "EnvelopePlot", "plot_envelope", "use_latex"),
+    # Development tests
+    "indev": ("do_check_pulse_broad", "IdBank", "correlate_id_vemco", "do_cfar_adapt"),
+}
+
+_SUBMODULES = tuple(_EXPORTS)
+
+# Name -> submodule, the last one listed wins
+_NAMES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return _import_module(f".{name}", __name__)
+
+    module = _NAMES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = globals()[name] = getattr(_import_module(f".{module}", __name__), name)
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS) | set(_NAMES))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of intermediate arrays, content addressed: the key is a hash
+of the input file contents, the stage, its parameters and the demlib code.
+Entries are .npy files memory-mapped on reload, evicted least recently
+used first above a size cap.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import ast
+import shutil
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+# Modules that compute the cached arrays, with the demlib modules they import
+# any change of them invalidates the cache
+_STAGE_MODULES = ("core", "utils", "indev", "sweep")
+
+
+def _sources(folder):
+    # demlib modules imported by the stage modules, followed recursively
+    names, pending = set(), list(_STAGE_MODULES)
+    while pending:
+        name = pending.pop()
+        if name in names:
+            continue
+        names.add(name)
+
+        with open(os.path.join(folder, f"{name}.py"), "rb") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.level == 1:
+                pending += [node.module] if node.module else [alias.name for alias in node.names]
+
+    return sorted(names)
+
+
+@lru_cache(maxsize=None)
+def code_version():
+
+    """
+    Hash of the demlib processing code, the stage modules and every demlib
+    module they import
+    """
+
+    h = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in _sources(folder):
+        with open(os.path.join(folder, f"{name}.py"), "rb") as f:
+            h.update(name.encode() + f.read())
+
+    return h.hexdigest()[:16]
+
+
+def array_hash(*arrays):
+
+    """
+    Short hash of the values of some arrays, e.g. filter coefficients, to
+    put them in a key
+    """
+
+    h = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        h.update(repr(array.shape).encode() + array.tobytes())
+
+    return h.hexdigest()[:16]
+
+
+class ArrayCache:
+
+    """
+    Content-addressed cache of numpy arrays
+
+    Parameters:
+    root (str): cache folder, created if missing
+    max_bytes (int): size cap, the least recently used entries go first
+    """
+
+    def __init__(self, root, max_bytes=2*2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, "files"), exist_ok=True)
+
+    #######################################################
+    # KEYS
+    #######################################################
+
+    def file_hash(self, file, chunk=2**24):
+
+        """
+        SHA-256 of a file, remembered on disk while its size and
+        modification time do not change
+        """
+
+        st = os.stat(file)
+        stamp = f"{st.st_size} {st.st_mtime_ns}"
+        record = os.path.join(self.root, "files", hashlib.sha256(os.path.abspath(file).encode()).hexdigest())
+
+        if os.path.exists(record):
+            with open(record) as f:
+                saved_stamp, _, digest = f.read().rpartition(" ")
+            if saved_stamp == stamp:
+                return digest
+
+        h = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(chunk), b""):
+                h.update(block)
+        digest = h.hexdigest()
+
+        with open(record, "w") as f:
+            f.write(f"{stamp} {digest}")
+
+        return digest
+
+    def key(self, file, stage, params):
+
+        """
+        Key of a stage output
+
+        Parameters:
+        file (str): input recording
+        stage (str): stage name, e.g. "method"
+        params: stage parameters, anything with a stable repr (tuple, dict)
+
+        Returns:
+        key (str): hex digest
+        """
+
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        text = repr((self.file_hash(file), stage, params, code_version()))
+
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    #######################################################
+    # ENTRIES
+    #######################################################
+
+    def load(self, key):
+
+        """
+        Arrays of an entry, memory-mapped read only, None if missing
+        """
+
+        path = os.path.join(self.root, key)
+        if not os.path.isdir(path):
+            return None
+
+        count = len([name for name in os.listdir(path) if name.endswith(".npy")])
+        arrays = tuple(np.load(os.path.join(path, f"{i}.npy"), mmap_mode="r") for i in range(count))
+        os.utime(path)  # Recently used
+
+        return arrays
+
+    def save(self, key, *arrays):
+
+        """
+        Store the arrays of an entry and evict above the size cap
+        """
+
+        path = os.path.join(self.root, key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+
+        os.makedirs(tmp, exist_ok=True)
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(tmp, f"{i}.npy"), np.asarray(array))
+
+        # Atomic publish, another process may have stored it first
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def get(self, key, compute):
+
+        """
+        Arrays of an entry, computed with compute() and stored when missing
+        """
+
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = compute()
+            arrays = arrays if isinstance(arrays, tuple) else (arrays,)
+            self.save(key, *arrays)
+
+        return arrays
+
+    def evict(self):
+
+        """
+        Remove the least recently used entries until the cache fits the cap
+        """
+
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name == "files" or name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Logic-analyzer captures: CSV exports (Saleae style, a time column and one
+column per channel) read in streaming batches with pyarrow and converted
+once to a raw binary cache. Later opens memory-map the cache, and the
+samples go through the pipeline like those of open_wav.
+
+Needs pyarrow for the conversion, the cache opens without it.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def _csv_reader(file, names, block_size):
+    try:
+        from pyarrow import csv
+    except ImportError as e:
+        raise ImportError("Reading CSV captures needs pyarrow: pip install pyarrow") from e
+
+    return csv.open_csv(file, read_options=csv.ReadOptions(block_size=block_size),
+                        convert_options=csv.ConvertOptions(include_columns=names))
+
+
+#######################################################
+# CACHE
+#######################################################
+
+def capture_cache(file, columns, time_column, dtype, cache=None):
+
+    """
+    Cache files of a capture, one per set of columns read
+
+    Parameters:
+    file (str): CSV capture
+    columns (list): data columns
+    time_column (str): time column, None none, the sample rate depends on it
+    dtype (str): sample type in the cache
+    cache (str): cache folder, default .capture_cache next to the CSV
+
+    Returns:
+    data (str): raw samples, (rows, columns) in row order
+    meta (str): JSON description, written last, the conversion is complete when it exists
+    """
+
+    file = os.path.abspath(file)
+    if cache is None:
+        cache = os.path.join(os.path.dirname(file), ".capture_cache")
+    os.makedirs(cache, exist_ok=True)
+
+    key = hashlib.sha256(json.dumps([file, list(columns), time_column, dtype]).encode()).hexdigest()[:16]
+    name = os.path.join(cache, f"{os.path.splitext(os.path.basename(file))[0]}-{key}")
+
+    return name + ".bin", name + ".json"
+
+
+def convert_csv(file, columns, time_column, data, meta, dtype="float32", block_size=1 << 24):
+
+    """
+    Stream a CSV capture into the raw cache, a block of rows at a time
+
+    Parameters:
+    file (str): CSV capture
+    columns (list): data columns
+    time_column (str): time column in seconds to get the sample rate, None none
+    data, meta (str): cache files, from capture_cache
+    dtype (str): sample type in the cache
+    block_size (int): CSV bytes per batch, bounds the memory
+
+    Returns:
+    info (dict): the meta written
+    """
+
+    names = list(columns) + ([time_column] if time_column else [])
+    st = os.stat(file)
+
+    rows = 0
+    first = last = None
+    with open(data + ".tmp", "wb") as f:
+        for batch in _csv_reader(file, names, block_size):
+            if batch.num_rows == 0:
+                continue
+
+            # Row order, as the data chunk of a WAV
+            block = np.column_stack([batch.column(name).to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+                                     for name in columns])
+            block.tofile(f)
+            rows += batch.num_rows
+
+            if time_column:
+                times = batch.column(time_column)
+                first = times[0].as_py() if first is None else first
+                last = times[-1].as_py()
+
+    os.replace(data + ".tmp", data)
+
+    info = {"source": os.path.abspath(file), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "columns": list(columns), "time_column": time_column, "dtype": dtype, "rows": rows,
+            "sample_rate": (rows - 1) / (last - first) if time_column and rows > 1 and last > first else None}
+
+    with open(meta + ".tmp", "w") as f:
+        json.dump(info, f, indent=2)
+    os.replace(meta + ".tmp", meta)
+
+    return info
+
+
+#######################################################
+# READ DATA
+#######################################################
+
+def open_csv(file, columns="Data", time_column="Time(s)", sample_rate=None, cache=None, dtype="float32",
+             block_size=1 << 24):
+
+    """
+    Memory-map the samples of a CSV capture, converting it on the first open
+
+    The cache is used while the size and modification time of the CSV do
+    not change, a reload only reads the small JSON description.
+
+    Parameters:
+    file (str): CSV capture
+    columns (str or list): data column, or columns for several channels
+    time_column (str): time column in seconds, gives the sample rate
+    sample_rate (float): sample rate, overrides the time column
+    cache (str): cache folder, default .capture_cache next to the CSV
+    dtype (str): sample type, float32 holds the analyzer resolution
+    block_size (int): CSV bytes per batch in the conversion
+
+    Returns:
+    sample_rate (float): sampling rate of the capture, fractional rates kept
+    samples (np.memmap): read-only samples, (n_samples,) or (n_samples, channels) as open_wav
+    """
+
+    names = [columns] if isinstance(columns, str) else list(columns)
+    data, meta = capture_cache(file, names, time_column, dtype, cache)
+
+    info = None
+    if os.path.exists(meta) and os.path.exists(data):
+        with open(meta) as f:
+            info = json.load(f)
+        st = os.stat(file)
+        if (info["size"], info["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            info = None  # The capture changed
+
+    if info is None:
+        info = convert_csv(file, names, time_column, data, meta, dtype, block_size)
+
+    if info["rows"] == 0:
+        raise ValueError(f"No samples in {file}")
+
+    rate = sample_rate or info["sample_rate"]
+    if not rate:
+        raise ValueError(f"No sample rate for {file}, give a time column or the sample rate")
+    if not np.isfinite(rate) or rate <= 0:
+        raise ValueError(f"Invalid sample rate {rate} for {file}")
+
+    shape = (info["rows"], len(names)) if len(names) > 1 else (info["rows"],)
+    samples = np.memmap(data, dtype=info["dtype"], mode="r", shape=shape)
+
+    return float(rate), samples
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+MCU cost model: operations, memory accesses and RAM of each processing
+stage as the target would run it (single precision, CMSIS-DSP style),
+mapped to Cortex-M4 cycles and energy with a configurable cost table.
+
+The counts are per output value of the stage (one buffer, or one hop for
+the sliding Goertzel), from the same parameters as the Python methods.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+from math import log2, floor, ceil, trunc, gcd
+
+from .core import _cfar_guard, _lo_table
+
+# STM32L432 (Cortex-M4F) at 80 MHz, run mode 84 uA/MHz at 3.3 V
+COST_TABLE = {
+    "cycles": {
+        "mul": 1,  # VMUL.F32
+        "add": 1,  # VADD/VSUB.F32, also abs
+        "mac": 3,  # VFMA.F32
+        "div": 14,  # VDIV.F32
+        "sqrt": 14,  # VSQRT.F32
+        "cmp": 2,  # VCMP + branch
+        "load": 2,  # LDR/VLDR, one wait state from flash tables
+        "store": 1,  # STR/VSTR
+    },
+    "clock_hz": 80e6,
+    "nj_per_cycle": 84 * 3.3 * 1e-3,  # 84 uA/MHz * 3.3 V = 277 pJ per cycle, * 1e-3 = 0.277 nJ per cycle
+}
+
+OPS = tuple(COST_TABLE["cycles"])
+FLOAT_BYTES = 4
+
+
+def _counts(ram=0, **ops):
+    counts = dict.fromkeys(OPS, 0)
+    counts.update(ops)
+    counts["ram"] = ram
+    return counts
+
+
+#######################################################
+# METHODS, per buffer
+#######################################################
+
+def count_fft(N, sample_rate, onFreq, offFreq):
+
+    """
+    Window, real FFT (N/2 point radix-2 complex FFT plus split) and the mean
+    magnitude of the band bins, as do_fft
+    """
+
+    M = N // 2
+    butterflies = M // 2 * log2(M)
+    bins = max(min(ceil(offFreq * N / sample_rate), M) - floor(onFreq * N / sample_rate), 1)
+
+    return _counts(
+        mul=N + 4*butterflies + 4*M + 2*bins + 1,
+        add=6*butterflies + 6*M + 2*bins,
+        sqrt=bins,
+        div=1,
+        load=2*N + 6*butterflies + 4*M + 2*bins,
+        store=N + 4*butterflies + 2*M,
+        ram=FLOAT_BYTES * (N + N + N + M),  # buffer, window, spectrum, twiddles
+    )
+
+
+def count_goertzel(N, n_freqs=1):
+
+    """
+    Goertzel recurrence s = x + coef*s_prev - s_prev2 and final power, as
+    do_goertzel and complementary/C/goertzel.c
+    """
+
+    return _counts(
+        mac=N*n_freqs,
+        add=2*N*n_freqs + 2*n_freqs,
+        mul=3*n_freqs,
+        cmp=n_freqs - 1,
+        load=N*n_freqs,
+        ram=FLOAT_BYTES * (N + 3*n_freqs),
+    )
+
+
+def count_filter(N, sample_rate, frequency, f_lo, taps_antialiassing, taps_bandpass):
+
+    """
+    LO mixing folded in the anti-aliasing taps (only at the kept samples),
+    band-pass at the decimated rate and mean magnitude, as do_filter. The
+    modulated taps are stored for one period of the LO at the kept samples
+    """
+
+    factor = trunc(frequency / (frequency - f_lo))
+    D = N / factor  # Decimated samples per buffer
+    A, B = taps_antialiassing, taps_bandpass
+
+    table = _lo_table(f_lo, sample_rate)
+    rows = len(table) // gcd(len(table), factor) if table is not None else 1
+
+    return _counts(
+        mac=D*(A + B),
+        add=2*D,
+        div=1,
+        load=D*(2*A + 2*B),
+        store=2*D,
+        ram=FLOAT_BYTES * (N + rows*A + B + (A - 1) + (B - 1)),
+    )
+
+
+def count_sdft(length, hop, n_freqs=1):
+
+    """
+    Sliding DFT per hop: every new sample rotates the bin state and swaps
+    the oldest sample of the window, then the power of the bin
+    """
+
+    return _counts(
+        mul=hop*4*n_freqs + 2*n_freqs,
+        add=hop*4*n_freqs + n_freqs,
+        cmp=n_freqs - 1,
+        load=hop*(2 + 2*n_freqs),
+        store=hop,
+        ram=FLOAT_BYTES * (length + 2*n_freqs),
+    )
+
+
+#######################################################
+# DETECTION, per value
+#######################################################
+
+def count_cfar(cells, guard, mode="ca"):
+
+    """
+    CFAR with running sums of the reference windows, OS keeps a sorted
+    window updated by insertion
+    """
+
+    window = 2*cells + 2*guard + 1
+
+    if mode == "os":
+        return _counts(
+            cmp=2*log2(max(2*cells, 2)) + 1,
+            load=2*cells + 1,
+            store=2*cells,
+            add=1,
+            ram=FLOAT_BYTES * (window + 2*cells),
+        )
+
+    extra = 0 if mode == "ca" else 1
+
+    return _counts(
+        add=4 + 1,
+        mul=1 + extra,
+        cmp=1 + extra,
+        load=4,
+        store=1,
+        ram=FLOAT_BYTES * window,
+    )
+
+
+def count_pulse():
+
+    """
+    Edge check of the detection and pulse width test
+    """
+
+    return _counts(cmp=2, add=1, load=1, store=1, ram=16)
+
+
+#######################################################
+# COST
+#######################################################
+
+def total(*counts):
+
+    """
+    Sum of stage counts, RAM is the sum of the stage buffers
+    """
+
+    out = _counts()
+    for c in counts:
+        for key in out:
+            out[key] += c[key]
+
+    return out
+
+
+def cost(counts, rate=1, table=COST_TABLE):
+
+    """
+    Cycles and energy of a count
+
+    Parameters:
+    counts (dict): operation counts per value, e.g. count_goertzel(256)
+    rate (float): values per second
+    table (dict): cycles per operation, clock and energy per cycle
+
+    Returns:
+    cost (dict): cycles per value, cycles per second, CPU load (0-1),
+                 energy per value and per second in uJ, RAM in bytes
+    """
+
+    cycles = sum(counts[op] * table["cycles"][op] for op in OPS)
+    uj = cycles * table["nj_per_cycle"] / 1000
+
+    return {
+        "cycles": cycles,
+        "cycles_s": cycles * rate,
+        "load": cycles * rate / table["clock_hz"],
+        "uj": uj,
+        "uj_s": uj * rate,
+        "ram": counts["ram"],
+    }
+
+
+def pipeline_cost(method, sample_rate, buffer, pulse_width, cells=None, hop=64, n_freqs=1, cfar="ca",
+                  onFreq=68000, offFreq=70000, frequency=69000, f_lo=58000, taps=(5, 25), table=COST_TABLE):
+
+    """
+    Cost of the main.py pipeline per second of signal: method, CFAR and
+    pulse check
+
+    Parameters:
+    method (int): 1: FFT, 2: Go, 3: Filt, 4: Sliding Go
+    sample_rate (float): Sampling rate of the uC in Hz.
+    buffer (int): Samples per buffer (window length for method 4).
+    pulse_width (int): width time of the pulse in ms
+    cells (int): CFAR cells, default as main.py
+    taps (tuple): anti-aliasing and band-pass taps
+
+    Returns:
+    cost (dict): see cost, the rate is values per second
+    """
+
+    step = hop if method == 4 else buffer
+    cells = buffer*10*buffer//step if cells is None else cells
+    guard = _cfar_guard(sample_rate, step, pulse_width)
+
+    if method == 1:
+        counts = count_fft(buffer, sample_rate, onFreq, offFreq)
+    elif method == 2:
+        counts = count_goertzel(buffer, n_freqs)
+    elif method == 3:
+        counts = count_filter(buffer, sample_rate, frequency, f_lo, *taps)
+    elif method == 4:
+        counts = count_sdft(buffer, hop, n_freqs)
+    else:
+        raise ValueError(f"Invalid method {method}")
+
+    return cost(total(counts, count_cfar(cells, guard, cfar), count_pulse()), sample_rate / step, table)
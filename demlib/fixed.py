@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Numeric formats of the target: float64 (reference), float32 and the Q15 and
+Q31 fixed-point formats, with round to nearest and saturation as the
+CMSIS-DSP q15/q31 functions.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import numpy as np
+
+FORMATS = ("float64", "float32", "q15", "q31")
+
+_FIXED = {"q15": (15, np.int16), "q31": (31, np.int32)}
+
+
+def frac_bits(fmt):
+
+    """
+    Fractional bits of a fixed-point format, None for floating point
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown numeric format {fmt}, one of {', '.join(FORMATS)}")
+
+    return _FIXED[fmt][0] if fmt in _FIXED else None
+
+
+def saturate(x, fmt):
+
+    """
+    Clip integers to the range of the format word
+    """
+
+    bits = frac_bits(fmt)
+    return np.clip(x, -(1 << bits), (1 << bits) - 1)
+
+
+def quantize(x, fmt, frac=None):
+
+    """
+    Real values to fixed point, round to nearest and saturate
+
+    Parameters:
+    x (np.array): real values, [-1, 1) for the default fractional bits
+    fmt (str): "q15" or "q31"
+    frac (int): fractional bits, default those of the format (e.g. 14 for
+                Q15 coefficients in [-2, 2))
+
+    Returns:
+    q (np.array int64): fixed-point values, in int64 for the arithmetic
+    """
+
+    frac = frac_bits(fmt) if frac is None else frac
+    return saturate(np.floor(np.asarray(x, dtype=float) * 2.0**frac + 0.5).astype(np.int64), fmt)
+
+
+def dequantize(q, fmt, frac=None):
+
+    """
+    Fixed point to real values
+    """
+
+    frac = frac_bits(fmt) if frac is None else frac
+    return np.asarray(q, dtype=float) / 2.0**frac
+
+
+def round_shift(x, shift, fmt):
+
+    """
+    Rescale a wide accumulator: add half an LSB, shift right and saturate
+    """
+
+    if shift <= 0:
+        return saturate(x << -shift, fmt)
+
+    return saturate((x + (1 << (shift - 1))) >> shift, fmt)
+
+
+def to_format(data, fmt, full_scale=32768):
+
+    """
+    ADC counts in a numeric format, in the storage type of the format
+
+    Parameters:
+    data (np.array): samples in ADC counts
+    fmt (str): "float64", "float32", "q15" or "q31"
+    full_scale (float): counts of the +-1 fixed-point range, int16 ADC by default
+
+    Returns:
+    data (np.array): float64, float32, int16 (Q15) or int32 (Q31)
+    """
+
+    if fmt == "float64":
+        return np.asarray(data, dtype=float)
+
+    if fmt == "float32":
+        return np.asarray(data, dtype=np.float32)
+
+    return quantize(np.asarray(data) / full_scale, fmt).astype(_FIXED[fmt][1])
@@ -1,6 +1,6 @@
 
 from .utils import *
-from math import ceil
+from .core import _cfar_guard, _cfar_cells
 
 #######################################################
 # ID correlation
@@ -22,7 +22,7 @@ def do_check_pulse_broad(data, sample_rate, buffer_length, packet):
     detect_times (list): Times wehere the pulse ends
     """
 
-    input = data[0:(len(data)-1)]
+    input = list(data[0:(len(data)-1)])
     detect = []
     detect_shifted = []
     detect_times = []
@@ -40,6 +40,148 @@ def do_check_pulse_broad(data, sample_rate, buffer_length, packet):
 
     return detect, detect_times
 
+def _id_mask(id_times, packet):
+
+    """
+    +1/-1 mask of an ID: +1 at the packet of each pulse, -1 elsewhere
+    """
+
+    mask = np.full(int(sum(id_times)/packet) + 1, -1)
+    mask[0] = 1
+
+    for i in range(1, len(id_times)):
+        mask[int(sum(id_times[:i])/packet)] = 1
+
+    mask[-1] = 1
+
+    return mask
+
+
+def _correlate_fft(data, masks):
+
+    """
+    Overlap-save correlation of each mask along the data, numpy FFT
+
+    Parameters:
+    data (np.array): (n,) signal, zero padded by the mask length - 1
+    masks (np.array): (n_masks, M) masks
+
+    Returns:
+    res (np.array): (n_masks, n - M + 1), res[i, j] = sum(data[j:j+M] * masks[i])
+    """
+
+    M = masks.shape[1]
+    out = len(data) - M + 1
+    L = 1 << max(4*M - 1, 64).bit_length()  # FFT length, about 3/4 of it valid
+    step = L - M + 1
+
+    # Blocks of L samples every step, the last one zero padded
+    blocks = -(-out // step)
+    data = np.concatenate((data, np.zeros(blocks*step + M - 1 - len(data))))
+    segments = np.lib.stride_tricks.sliding_window_view(data, L)[::step]
+
+    # Circular correlation, the first step values of each block wrap nothing
+    spectrum = np.fft.rfft(segments, L)[None, :, :] * np.conj(np.fft.rfft(masks, L))[:, None, :]
+    res = np.fft.irfft(spectrum, L)[:, :, :step]
+
+    return res.reshape(len(masks), -1)[:, :out]
+
+
+class IdBank:
+
+    """
+    Bank of ID masks correlated at once against the packet detections
+
+    All the masks are stacked (zero padded) in one matrix. A small bank is
+    correlated mask by mask with np.correlate, a large one with a numpy FFT
+    overlap-save along the data, all the masks at once.
+
+    Parameters:
+    ids (dict): ID name -> list of encoding times of the ID in ms
+    packet (int in ms): size of the grouping windows in ms
+    direct (int): largest bank correlated mask by mask
+    """
+
+    def __init__(self, ids, packet, direct=4):
+        masks = [_id_mask(id_times, packet) for id_times in ids.values()]
+
+        self.names = list(ids)
+        self.packet = packet
+        self.direct = direct
+        self.lengths = np.array([len(mask) for mask in masks])
+        self.pulses = np.array([np.count_nonzero(mask == 1) for mask in masks])
+
+        self.masks = np.zeros((len(masks), self.lengths.max()))
+        for i, mask in enumerate(masks):
+            self.masks[i, :len(mask)] = mask
+
+    def scores(self, data, rows=slice(None)):
+
+        """
+        Correlation score of every ID at every packet
+
+        Parameters:
+        data (list): 0-1 packet detections, e.g. from do_check_pulse_broad
+        rows (slice): IDs of the bank to correlate, default all
+
+        Returns:
+        scores (np.array): (n_ids, len(data)) score of each ID starting at
+                           each packet, nan where the ID does not fit
+        """
+
+        data = np.asarray(data, dtype=float)
+        masks = self.masks[rows]
+        scores = np.full((len(masks), len(data)), np.nan)
+        if len(data) == 0:
+            return scores
+
+        # Zeros after the data, every packet gets a score
+        M = masks.shape[1]
+        padded = np.concatenate((data, np.zeros(M - 1)))
+
+        if len(masks) <= self.direct:
+            for i, mask in enumerate(masks):
+                scores[i] = np.correlate(padded, mask, "valid")
+        else:
+            scores[:] = np.rint(_correlate_fft(padded, masks))
+
+        for i, length in enumerate(self.lengths[rows]):
+            scores[i, max(len(data) - length + 1, 0):] = np.nan
+
+        return scores
+
+    def detect(self, data, min_score=None, tile=32):
+
+        """
+        Peaks of the correlation above a score
+
+        Parameters:
+        data (list): 0-1 packet detections, e.g. from do_check_pulse_broad
+        min_score (int): Minimum score, default the number of pulses of each
+                         ID (all the pulses found).
+        tile (int): IDs correlated at once, bounds the memory.
+
+        Returns:
+        detections (list): (name, time in s of the ID start, score) for each peak
+        """
+
+        detections = []
+
+        for first in range(0, len(self.names), tile):
+            rows = slice(first, first + tile)
+            scores = self.scores(data, rows)
+            limit = self.pulses[rows] if min_score is None else np.full(len(scores), min_score)
+
+            # Local maxima (first of a plateau) over the minimum score
+            padded = np.pad(scores, ((0, 0), (1, 1)), constant_values=-np.inf)
+            peak = (scores > padded[:, :-2]) & (scores >= padded[:, 2:]) & (scores >= limit[:, None])
+
+            for i, j in zip(*np.nonzero(peak)):
+                detections.append((self.names[first + i], int(j)*self.packet/1000, int(scores[i, j])))
+
+        return sorted(detections, key=lambda d: d[1])
+
+
 def correlate_id_vemco(data, packet, id_times):
 
     """
@@ -51,76 +193,51 @@ def correlate_id_vemco(data, packet, id_times):
     id_times (list): list of encoding times of the ID
 
     Returns:
-    id_check (float) timestamp where the id is
+    check (list): correlation score where the whole ID fits
+    check_time (np.array): time of the end of the ID for each score
     """
 
-    # Make the Mask
-    id_translated = [-1]*int((sum(id_times)/packet))
-    id_translated[0] = 1
-
-    for i in range(1, len(id_times)):
-        index = int(sum(id_times[:i])/packet)
-        id_translated[index] = 1
-
-    id_translated.append(1)
-
-    # correlate the mask
-    check = list(np.correlate(data, id_translated, 'valid'))
+    bank = IdBank({"id": id_times}, packet)
+    length = bank.lengths[0]
+    check = bank.scores(data)[0, :max(len(data) - length + 1, 0)].astype(int).tolist()
 
-    if 8 in check:
-        ind = check.index(8)
+    # All the pulses of the ID found
+    if bank.pulses[0] in check:
+        ind = check.index(bank.pulses[0])
         print(f"Detection at {(ind*packet/1000)} s")
 
-    check_time = np.arange((len(id_translated)-1)*packet/1000,len(data)*packet/1000, 0.02)
+    check_time = np.arange((length-1)*packet/1000, len(data)*packet/1000, packet/1000)
 
     return check, check_time
 
 
-def do_cfar_adapt(data, sample_rate, buffer_len, pulse_width, cells):
+def do_cfar_adapt(data, sample_rate, buffer_len, pulse_width, cells, mode="ca", rank=0.75):
 
     """
     Implements CFAR to detect a signal
 
     Parameters:
-    data (list): Input signal samples.
+    data (list): Input signal samples, (channels, n) array for several channels.
     sample_rate (float): Sampling rate in Hz.
     buffer_len (float)
     pulse_width (int): width time of the pulse to calculate the guard time
     cells (int): number of cells to calculate CFAR
+    mode (str): "ca", "go", "so" or "os" noise estimate
+    rank (float): order statistic for "os", 0 min, 1 max
 
     Returns:
-    threshold (list): Calculated threshold for each index of the list
-    detec (list): List with 0-1 if the data is under the threshold
+    threshold (np.array): Calculated threshold for each index of the list
+    detec (np.array): 0-1 if the data is under the threshold
     """
 
-    threshold = []
-    detect = []
-    guard = 5*ceil(pulse_width * sample_rate / (buffer_len * 1000))
-    offset = 10
-    start = 0
-
-    for i in range(len(data)):
-        if data[i] == 0:
-            res = 1
-        elif i < (cells + guard + 1):
-            res = np.mean(data[(i+guard+1):(i+guard+cells)])/data[i]
-
-        elif i > (len(data)-cells-guard-1):
-            res = np.mean(data[(i-guard-cells):(i-guard-1)])/data[i]
-
-        else:
-            do_mean= data[(i-guard-cells):(i-guard-1)] + data[(i+guard+1):(i+guard+cells)]
-            res = np.mean(do_mean)/data[i]
-
-        #Detection
-        res = res-0.05
-        if data[i] > res:
-            detect.append(1)
-        else:
-            detect.append(0)
-
-        threshold.append(res)
+    guard = _cfar_guard(sample_rate, buffer_len, pulse_width)
 
+    length = np.shape(data)[-1]
+    threshold = _cfar_cells(data, 0, length, length, guard, cells, concat=isinstance(data, list),
+                            mode=mode, rank=rank)
 
+    #Detection
+    threshold = threshold-0.05
+    detect = (np.asarray(data) > threshold).astype(int)
 
-    return threshold, detect
\ No newline at end of file
+    return threshold, detect
@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+"""
+Live detection: raw int16 samples from stdin, a UNIX domain socket, a
+shared-memory ring buffer or one socket per hydrophone of an array through
+the streaming pipeline, detections and metrics out as JSON lines.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import asyncio
+import threading
+from bisect import bisect_right
+from functools import partial
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from .core import do_downsample_blocks
+from .profiling import NULL_PROFILER
+
+
+#######################################################
+# RING BUFFER
+#######################################################
+
+class SharedRing:
+
+    """
+    Single producer, single consumer ring of int16 samples in shared memory
+
+    The header holds the number of samples written so far, a closed flag, the
+    capacity, the number of samples read (-1 until a reader attaches) and the
+    end of the write in progress. A reader that falls more than `capacity`
+    samples behind loses the oldest ones, they are reported as lost. As in a
+    seqlock, the reader checks the write in progress again after its copy
+    and drops the samples the producer may have overwritten meanwhile.
+
+    Parameters:
+    name (str): shared memory name
+    capacity (int): samples in the ring, only when creating it
+    create (bool): create the ring (producer) or attach to it
+    """
+
+    HEADER = 5  # int64: written, closed, capacity, read, claimed
+
+    def __init__(self, name, capacity=1 << 22, create=False):
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=8*self.HEADER + 2*capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # The producer owns the segment, do not unlink it at exit
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self.owner = create
+        self.header = np.ndarray(self.HEADER, dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = (0, 0, capacity, -1, 0)
+
+        self.capacity = int(self.header[2])
+        self.data = np.ndarray(self.capacity, dtype=np.int16, buffer=self.shm.buf, offset=8*self.HEADER)
+
+        self.read_count = int(self.header[0])  # Readers start at the present
+        if not create:
+            self.header[3] = self.read_count
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=np.int16)
+        end = int(self.header[0]) + len(samples)
+
+        # Only the last capacity samples fit, the others count as written (lost)
+        samples = samples[-self.capacity:]
+        self.header[4] = end  # Claim the slots before overwriting them
+
+        start = (end - len(samples)) % self.capacity
+        head = min(len(samples), self.capacity - start)
+        self.data[start:start + head] = samples[:head]
+        self.data[:len(samples) - head] = samples[head:]
+
+        self.header[0] = end  # Publish after the data
+
+    def read(self, n):
+
+        """
+        Up to n samples, returns (samples, lost)
+        """
+
+        written = int(self.header[0])
+        lost = max(written - self.read_count - self.capacity, 0)
+        self.read_count += lost
+
+        n = min(n, written - self.read_count)
+        index = (self.read_count + np.arange(n)) % self.capacity
+        samples = self.data[index]
+
+        # Samples overwritten during the copy, by a write claimed since
+        torn = min(max(int(self.header[4]) - self.capacity - self.read_count, 0), n)
+        samples = samples[torn:]
+        lost += torn
+
+        self.read_count += n
+        self.header[3] = self.read_count
+
+        return samples, lost
+
+    @property
+    def reader(self):
+
+        """
+        Samples read by the attached reader, -1 if none
+        """
+
+        return int(self.header[3])
+
+    @property
+    def closed(self):
+        return bool(self.header[1])
+
+    def close(self):
+
+        """
+        Producer: mark the end of the stream
+        """
+
+        self.header[1] = 1
+
+    def release(self):
+        del self.header, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+#######################################################
+# SOURCES
+#######################################################
+
+class FileSource:
+
+    """
+    Raw little-endian int16 samples from a binary file object (stdin)
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n):
+        raw = self.f.read(2*n)
+        raw = raw[:len(raw) // 2 * 2]
+        return np.frombuffer(raw, dtype="<i2"), 0
+
+    def close(self):
+        pass
+
+
+class SocketSource:
+
+    """
+    Raw little-endian int16 samples from the first producer that connects
+    to a UNIX domain socket
+    """
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.path = path
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.conn = None
+        self.odd = b""
+
+    def read(self, n):
+        if self.conn is None:
+            self.conn, _ = self.server.accept()
+
+        raw = bytearray(self.odd)
+        while len(raw) < 2*n:
+            chunk = self.conn.recv(2*n - len(raw))
+            if not chunk:
+                break
+            raw += chunk
+
+        cut = len(raw) // 2 * 2
+        self.odd = bytes(raw[cut:])
+
+        return np.frombuffer(bytes(raw[:cut]), dtype="<i2"), 0
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.server.close()
+        os.unlink(self.path)
+
+
+class RingSource:
+
+    """
+    Samples from a SharedRing, waits `poll` seconds when it is empty or
+    until the producer creates it
+    """
+
+    def __init__(self, name, poll=0.001):
+        while True:
+            try:
+                self.ring = SharedRing(name)
+                break
+            except FileNotFoundError:
+                time.sleep(max(poll, 0.01))
+        self.poll = poll
+
+    def read(self, n):
+        while True:
+            closed = self.ring.closed
+            samples, lost = self.ring.read(n)
+            if len(samples) or lost or closed:
+                return samples, lost
+            time.sleep(self.poll)
+
+    def close(self):
+        self.ring.release()
+
+
+class ChannelSource:
+
+    """
+    Channels of a hydrophone array, one UNIX domain socket each, read
+    concurrently by an asyncio loop in a background thread and aligned into
+    (channels, n) blocks
+
+    Each channel reads ahead up to `backlog` samples and then stops reading
+    its socket until the detector catches up, so a slow detector or a
+    stalled channel backs up to the producers. The stream ends with the
+    first channel that ends.
+
+    Parameters:
+    paths (list): socket path of each channel
+    backlog (int): samples read ahead per channel
+    """
+
+    def __init__(self, paths, backlog=1 << 18):
+        self.paths = paths
+        self.backlog = backlog
+        self.buffers = [bytearray() for _ in paths]
+        self.ended = [False] * len(paths)
+
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._serve(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    async def _serve(self):
+        self.changed = asyncio.Condition()
+        self.stop = asyncio.Event()
+
+        self.servers = []
+        for c, path in enumerate(self.paths):
+            if os.path.exists(path):
+                os.unlink(path)
+            self.servers.append(await asyncio.start_unix_server(partial(self._channel, c), path))
+        self.ready.set()
+
+        await self.stop.wait()
+        for server in self.servers:
+            server.close()
+
+    async def _channel(self, c, reader, writer):
+        self.servers[c].close()  # One producer per channel
+
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: len(self.buffers[c]) < 2*self.backlog)
+
+            data = await reader.read(65536)
+            async with self.changed:
+                if data:
+                    self.buffers[c] += data
+                else:
+                    self.ended[c] = True
+                self.changed.notify_all()
+            if not data:
+                break
+
+        writer.close()
+
+    async def _read(self, n):
+        async with self.changed:
+            await self.changed.wait_for(lambda: all(len(b) >= 2*n or e for b, e in zip(self.buffers, self.ended)))
+
+            size = min([2*n] + [len(b) // 2 * 2 for b in self.buffers])
+            block = np.stack([np.frombuffer(bytes(b[:size]), dtype="<i2") for b in self.buffers])
+            for b in self.buffers:
+                del b[:size]
+            self.changed.notify_all()
+
+        return block
+
+    def read(self, n):
+        return asyncio.run_coroutine_threadsafe(self._read(n), self.loop).result(), 0
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.stop.set)
+        self.thread.join()
+        self.loop.close()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def open_source(spec):
+
+    """
+    Sample source from its spec: "stdin", "unix:PATH" or "ring:NAME", or a
+    list of "unix:PATH" for the channels of an array
+    """
+
+    if not isinstance(spec, str):
+        if len(spec) == 1:
+            return open_source(spec[0])
+        if not all(s.startswith("unix:") for s in spec):
+            raise ValueError("The channels of an array are unix:PATH sources")
+        return ChannelSource([s[5:] for s in spec])
+
+    if spec in ("stdin", "-"):
+        return FileSource(sys.stdin.buffer)
+    if spec.startswith("unix:"):
+        return SocketSource(spec[5:])
+    if spec.startswith("ring:"):
+        return RingSource(spec[5:])
+
+    raise ValueError(f"Unknown source {spec}, use stdin, unix:PATH or ring:NAME")
+
+
+#######################################################
+# DETECTOR
+#######################################################
+
+class LiveDetector:
+
+    """
+    Run a StreamEngine on a live source
+
+    A reader thread puts chunks of samples on a bounded queue, the pipeline
+    takes them in the calling thread. When the queue is full the reader
+    either waits (backpressure on the producer, the time is reported) or
+    drops the chunk. Detection times are in seconds from the first sample,
+    dropped samples included.
+
+    Parameters:
+    source: object with read(n) -> (int16 samples, lost samples), see open_source,
+            (channels, n) samples for an array
+    engine (StreamEngine, or ArrayEngine for an array): detection pipeline
+    input_rate (float): sample rate of the source in Hz
+    sample_rate (float): sample rate of the uC (after downsampling) in Hz
+    frontend (callable): downsampled (offset, block) iterable -> (buffer, times)
+                         iterable, e.g. lambda b: do_buffers_blocks(b, 256, 150000)
+    step (int): downsampled samples per method value
+    chunk (int): samples per read
+    queue_size (int): chunks in the queue, bounds the latency
+    overflow (str): "block" or "drop" when the queue is full
+    metrics (float): seconds of signal between metrics lines, 0 none
+    out: file for the JSON lines
+    profiler (Profiler): time of the front end stages, give the same one
+                         to the engine for the rest, default none
+    """
+
+    def __init__(self, source, engine, input_rate, sample_rate, frontend, step, chunk=4096, queue_size=64,
+                 overflow="block", metrics=1.0, out=sys.stdout, profiler=NULL_PROFILER):
+        if overflow not in ("block", "drop"):
+            raise ValueError("Overflow must be block or drop")
+
+        self.source = source
+        self.engine = engine
+        self.input_rate = input_rate
+        self.sample_rate = sample_rate
+        self.frontend = frontend
+        self.step = step
+        self.chunk = chunk
+        self.overflow = overflow
+        self.metrics = metrics
+        self.out = out
+        self.profiler = profiler
+
+        self.queue = queue.Queue(queue_size)
+        self.gaps = [(0, 0)]  # (processed samples, samples lost before them)
+        self.stats = dict(samples=0, values=0, pulses=0, symbols=0, lost_samples=0, dropped_chunks=0,
+                          dropped_samples=0, queue_max=0, backpressure_s=0.0, idle_s=0.0)
+
+    #######################################################
+    # READER THREAD
+    #######################################################
+
+    def _gap(self, offset, n):
+        self.gaps.append((offset, self.gaps[-1][1] + n))
+
+    def _read(self):
+        # Ends with None, or with the exception of the source for run to raise
+        offset = 0
+        end = None
+        try:
+            while True:
+                samples, lost = self.source.read(self.chunk)
+                if lost:
+                    self.stats["lost_samples"] += lost
+                    self._gap(offset, lost)
+                if samples.shape[-1] == 0:
+                    if lost:
+                        continue
+                    break
+
+                if self.overflow == "drop":
+                    try:
+                        self.queue.put_nowait((offset, samples))
+                    except queue.Full:
+                        self.stats["dropped_chunks"] += 1
+                        self.stats["dropped_samples"] += samples.shape[-1]
+                        self._gap(offset, samples.shape[-1])
+                        continue
+                else:
+                    t0 = time.perf_counter()
+                    self.queue.put((offset, samples))
+                    self.stats["backpressure_s"] += time.perf_counter() - t0
+
+                self.stats["queue_max"] = max(self.stats["queue_max"], self.queue.qsize())
+                offset += samples.shape[-1]
+        except Exception as error:
+            end = error
+        finally:
+            self.queue.put(end)
+
+    def _chunks(self):
+        while True:
+            t0 = time.perf_counter()
+            item = self.queue.get()
+            self.stats["idle_s"] += time.perf_counter() - t0
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            self.stats["samples"] += item[1].shape[-1]
+            yield item
+
+    #######################################################
+    # OUTPUT
+    #######################################################
+
+    def _time(self, t):
+        # Processed time to source time, adding the samples lost before it
+        i = bisect_right(self.gaps, (t * self.input_rate, np.inf)) - 1
+        return t + self.gaps[i][1] / self.input_rate
+
+    def _emit(self, event, **fields):
+        print(json.dumps({"event": event, **fields}), file=self.out, flush=True)
+
+    def _emit_detections(self, times, symbols):
+        for t in times:
+            # Array: fused pulse with the arrival on each channel
+            if isinstance(t, dict):
+                self._emit("pulse", time=round(self._time(t["time"]), 6), channels=t["channels"],
+                           toa=[None if a is None else round(self._time(a), 6) for a in t["toa"]])
+            else:
+                self._emit("pulse", time=round(self._time(t), 6))
+
+        if symbols:
+            last = times[-1]["time"] if isinstance(times[-1], dict) else times[-1]
+            self._emit("decode", time=round(self._time(last), 6), symbols=symbols)
+
+        self.stats["pulses"] += len(times)
+        self.stats["symbols"] += len(symbols)
+
+    def _emit_metrics(self, wall):
+        # Real-time factor: processing time (not waiting for samples) per second of signal
+        signal = self.stats["samples"] / self.input_rate
+        busy = wall - self.stats["idle_s"]
+        self._emit("metrics",
+                   time=round(signal, 3),
+                   wall=round(wall, 3),
+                   rtf=round(busy / signal, 4) if signal else None,
+                   latency_s=round(self.engine.cfar.latency * self.step / self.sample_rate, 3),
+                   queue=self.queue.qsize(),
+                   **{k: round(v, 4) if isinstance(v, float) else v for k, v in self.stats.items()})
+
+    #######################################################
+    # RUN
+    #######################################################
+
+    def run(self):
+
+        """
+        Process the source until it ends, returns the final stats
+        """
+
+        reader = threading.Thread(target=self._read, daemon=True)
+        start = time.perf_counter()
+        reader.start()
+
+        next_metrics = self.metrics
+        try:
+            # "read" is the wait for the reader thread
+            block_items = lambda block: block[1].shape[-1]
+            chunks = self.profiler.iterate("read", self._chunks(), block_items)
+            blocks = self.profiler.iterate("downsample", do_downsample_blocks(chunks, self.input_rate / self.sample_rate),
+                                           block_items)
+            buffers = self.profiler.iterate("buffers", self.frontend(blocks), lambda buffer: np.shape(buffer[0])[-2])
+            for buffer, _ in buffers:
+                times, symbols = self.engine.feed(buffer)
+                self.stats["values"] += np.shape(buffer)[-2]
+                self._emit_detections(times, symbols)
+
+                if self.metrics and self.stats["samples"] / self.input_rate >= next_metrics:
+                    self._emit_metrics(time.perf_counter() - start)
+                    next_metrics += self.metrics
+
+            self._emit_detections(*self.engine.close())
+
+        finally:
+            self.source.close()
+
+        self._emit_metrics(time.perf_counter() - start)
+
+        return self.stats
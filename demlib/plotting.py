@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Plots of long recordings: a signal is drawn as the min/max envelope of each
+pixel column, taken from a precomputed multi-level pyramid, and redrawn at
+the right level when the x limits change (zoom, pan). A line never holds
+more than a few points per pixel, whatever the length of the recording.
+
+matplotlib is not imported here, the functions work on the axes given.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import shutil
+from math import ceil
+
+import numpy as np
+
+from .core import iter_blocks
+
+
+#######################################################
+# PYRAMID
+#######################################################
+
+def envelope_pyramid(data, base=64, factor=4, min_bins=512, block_len=1 << 22):
+
+    """
+    Min/max pyramid of a long signal
+
+    Level k holds the min and max of each run of base*factor**k samples (the
+    last run may be shorter). The first level is computed block by block, a
+    memory-mapped recording is never loaded as a whole.
+
+    Parameters:
+    data (np.array): signal, (n,) or (channels, n)
+    base (int): samples per bin of the first level
+    factor (int): bins merged from one level to the next
+    min_bins (int): no coarser level below this number of bins
+    block_len (int): samples read at a time, multiple of base
+
+    Returns:
+    levels (list): (step, low, high) per level, finest first, low and high
+                   (n_bins,) or (channels, n_bins) in the type of data
+    """
+
+    n = np.shape(data)[-1]
+    bins = ceil(n / base)
+    low = np.empty(np.shape(data)[:-1] + (bins,), dtype=np.asarray(data[..., :0]).dtype)
+    high = np.empty_like(low)
+
+    block_len = max(block_len // base, 1) * base
+    for offset, block in iter_blocks(data, block_len):
+        starts = np.arange(0, block.shape[-1], base)
+        i = offset // base
+        low[..., i:i + len(starts)] = np.minimum.reduceat(block, starts, axis=-1)
+        high[..., i:i + len(starts)] = np.maximum.reduceat(block, starts, axis=-1)
+
+    levels = [(base, low, high)]
+    while low.shape[-1] >= max(min_bins, 2) * factor:
+        starts = np.arange(0, low.shape[-1], factor)
+        low = np.minimum.reduceat(low, starts, axis=-1)
+        high = np.maximum.reduceat(high, starts, axis=-1)
+        levels.append((levels[-1][0] * factor, low, high))
+
+    return levels
+
+
+#######################################################
+# PLOT
+#######################################################
+
+class EnvelopePlot:
+
+    """
+    Line of a long uniformly sampled signal, redrawn as the min/max envelope
+    of the visible samples each time the x limits change
+
+    The coarsest pyramid level whose bins are no wider than a pixel at the
+    current zoom is drawn, two points per bin. Zoomed in to less than
+    `base` samples per pixel the samples are drawn as they are.
+
+    Parameters:
+    ax (matplotlib Axes): axes to draw on
+    data (np.array): (n,) signal
+    t0 (float): time of the first sample
+    dt (float): time between samples
+    levels (list): envelope_pyramid(data), computed if None
+    kwargs: Line2D properties, e.g. color, alpha, label
+    """
+
+    def __init__(self, ax, data, t0, dt, levels=None, **kwargs):
+        self.ax = ax
+        self.data = data
+        self.t0 = t0
+        self.dt = dt
+        self.levels = envelope_pyramid(data) if levels is None else levels
+
+        (self.line,) = ax.plot([], [], **kwargs)
+
+        # Limits of the whole signal, from the coarsest level
+        _, low, high = self.levels[-1]
+        if low.size:
+            ax.update_datalim([(t0, float(low.min())), (t0 + len(data) * dt, float(high.max()))])
+            ax.autoscale_view()
+
+        ax.callbacks.connect("xlim_changed", self.update)
+        self.update(ax)
+
+    def update(self, ax=None):
+        n = len(self.data)
+        start, stop = self.ax.get_xlim()
+        i0 = min(max(int((start - self.t0) / self.dt), 0), n)
+        i1 = min(max(ceil((stop - self.t0) / self.dt) + 1, 0), n)
+        per_pixel = (i1 - i0) / max(self.ax.bbox.width, 1)
+
+        # Coarsest level still finer than a pixel
+        level = None
+        for step, low, high in self.levels:
+            if step <= per_pixel:
+                level = (step, low, high)
+
+        if level is None:
+            x = self.t0 + np.arange(i0, i1) * self.dt
+            y = self.data[i0:i1]
+        else:
+            step, low, high = level
+            b0, b1 = i0 // step, ceil(i1 / step)
+            x = np.repeat(self.t0 + (np.arange(b0, b1) + 0.5) * step * self.dt, 2)
+            y = np.column_stack((low[b0:b1], high[b0:b1])).ravel()
+
+        self.line.set_data(x, y)
+
+
+def plot_envelope(ax, data, t0, dt, **kwargs):
+
+    """
+    EnvelopePlot of each channel of a (n,) or (channels, n) signal
+
+    Returns:
+    plots (list): one EnvelopePlot per channel, keep them while the figure is open
+    """
+
+    data = np.asarray(data)
+    data = data[None] if data.ndim == 1 else data
+    levels = envelope_pyramid(data)
+
+    return [EnvelopePlot(ax, channel, t0, dt, [(step, low[c], high[c]) for step, low, high in levels], **kwargs)
+            for c, channel in enumerate(data)]
+
+
+def use_latex(enable=True):
+
+    """
+    LaTeX text when asked for and installed, the faster mathtext otherwise
+
+    Returns:
+    usetex (bool): LaTeX in use
+    """
+
+    import matplotlib
+
+    usetex = bool(enable) and shutil.which("latex") is not None
+    matplotlib.rcParams["text.usetex"] = usetex
+    if not usetex:
+        matplotlib.rcParams["axes.labelweight"] = "bold"
+
+    return usetex
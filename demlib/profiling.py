@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage profiling: wall time, CPU time, peak allocated memory and items
+processed by each stage of the pipeline, exported as JSON or as a Chrome
+trace (chrome://tracing, Perfetto) for flame views. Opt-in, the stages run
+through NULL_PROFILER when it is off.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+
+FIELDS = ("calls", "items", "wall_s", "cpu_s", "self_wall_s", "self_cpu_s", "peak_bytes")
+
+
+#######################################################
+# STAGES
+#######################################################
+
+class _Stage:
+
+    """
+    One running stage, the context manager returned by Profiler.stage.
+    `items` can be set or increased inside the block.
+    """
+
+    __slots__ = ("profiler", "name", "items", "wall", "cpu", "child_wall", "child_cpu", "base", "peak")
+
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.profiler._enter(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self)
+        return False
+
+
+class _NullStage:
+
+    __slots__ = ("items",)
+
+    def __init__(self):
+        self.items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProfiler:
+
+    """
+    Profiler that records nothing, the default of every instrumented stage
+    """
+
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name, items=0):
+        return self._stage
+
+    def iterate(self, name, iterable, items=None):
+        return iterable
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler:
+
+    """
+    Record the stages of a run
+
+    Stages nest: the wall and CPU times include the inner stages, the self
+    times do not. With a generator chain (read -> downsample -> buffers)
+    wrapped by iterate, the self time is the cost of each link.
+
+    Parameters:
+    memory (bool): peak allocated memory per stage with tracemalloc, it
+                   slows the run several times
+    trace (bool): keep one event per stage call for the Chrome trace
+    max_events (int): trace events kept, the rest are only counted
+    """
+
+    enabled = True
+
+    def __init__(self, memory=False, trace=True, max_events=1000000):
+        self.memory = memory
+        self.trace = trace
+        self.max_events = max_events
+
+        self.stages = {}  # name -> totals, see FIELDS
+        self.events = []  # Chrome trace events
+        self.dropped_events = 0
+        self.pid = os.getpid()
+        self._local = threading.local()  # Stack of running stages per thread
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name, items=0):
+
+        """
+        Context manager timing a stage, e.g.
+
+            with profiler.stage("cfar", len(values)):
+                ...
+        """
+
+        return _Stage(self, name, items)
+
+    def iterate(self, name, iterable, items=None):
+
+        """
+        Time each step of an iterable (a streamed stage)
+
+        Parameters:
+        name (str): stage name
+        iterable: e.g. the (offset, block) generator of iter_blocks
+        items (callable): items of each element, default 1
+        """
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as s:
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    return
+                s.items = items(element) if items else 1
+            yield element
+
+    #######################################################
+    # RECORD
+    #######################################################
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, s):
+        stack = self._stack()
+        s.child_wall = s.child_cpu = 0.0
+
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)  # Before the reset hides it
+            tracemalloc.reset_peak()
+            s.base = s.peak = current
+
+        stack.append(s)
+        s.cpu = time.thread_time()
+        s.wall = time.perf_counter()
+
+    def _exit(self, s):
+        wall = time.perf_counter() - s.wall
+        cpu = time.thread_time() - s.cpu
+        stack = self._stack()
+        stack.pop()
+
+        peak = 0
+        if self.memory:
+            s.peak = max(s.peak, tracemalloc.get_traced_memory()[1])
+            peak = s.peak - s.base
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, s.peak)
+
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+
+        totals = self.stages.get(s.name)
+        if totals is None:
+            totals = self.stages[s.name] = dict.fromkeys(FIELDS, 0)
+        totals["calls"] += 1
+        totals["items"] += s.items
+        totals["wall_s"] += wall
+        totals["cpu_s"] += cpu
+        totals["self_wall_s"] += wall - s.child_wall
+        totals["self_cpu_s"] += cpu - s.child_cpu
+        totals["peak_bytes"] = max(totals["peak_bytes"], peak)
+
+        if self.trace:
+            if len(self.events) < self.max_events:
+                args = {"items": s.items, "cpu_ms": round(cpu*1e3, 3)}
+                if self.memory:
+                    args["peak_bytes"] = peak
+                self.events.append({"name": s.name, "ph": "X", "ts": round(s.wall*1e6, 1),
+                                    "dur": round(wall*1e6, 1), "pid": self.pid,
+                                    "tid": threading.get_ident(), "args": args})
+            else:
+                self.dropped_events += 1
+
+    #######################################################
+    # REPORT
+    #######################################################
+
+    def report(self):
+
+        """
+        Totals per stage and trace events, a plain dict (JSON, pickle)
+        """
+
+        return {"stages": {name: dict(totals) for name, totals in self.stages.items()},
+                "events": list(self.events), "dropped_events": self.dropped_events}
+
+    def merge(self, report):
+
+        """
+        Add the report of another run, e.g. of each file of a batch
+        """
+
+        for name, totals in report["stages"].items():
+            mine = self.stages.setdefault(name, dict.fromkeys(FIELDS, 0))
+            for field in FIELDS:
+                if field == "peak_bytes":
+                    mine[field] = max(mine[field], totals[field])
+                else:
+                    mine[field] += totals[field]
+
+        room = max(self.max_events - len(self.events), 0)
+        self.events += report["events"][:room]
+        self.dropped_events += report["dropped_events"] + max(len(report["events"]) - room, 0)
+
+    def summary(self):
+
+        """
+        Stages as a text table, slowest self time first
+        """
+
+        lines = [f"{'stage':<14}{'calls':>8}{'items':>12}{'wall s':>10}{'self s':>10}{'cpu s':>10}{'peak MB':>9}"]
+        for name, t in sorted(self.stages.items(), key=lambda s: -s[1]["self_wall_s"]):
+            lines.append(f"{name:<14}{t['calls']:>8}{t['items']:>12}{t['wall_s']:>10.4f}{t['self_wall_s']:>10.4f}"
+                         f"{t['cpu_s']:>10.4f}{t['peak_bytes'] / 2**20:>9.1f}")
+
+        return "\n".join(lines)
+
+    def save(self, prefix):
+
+        """
+        Write `prefix`.json (totals per stage) and `prefix`.trace.json (Chrome
+        trace events)
+
+        Returns:
+        paths (tuple): JSON and trace files
+        """
+
+        paths = (f"{prefix}.json", f"{prefix}.trace.json")
+
+        with open(paths[0], "w") as f:
+            json.dump({"stages": self.stages, "dropped_events": self.dropped_events}, f, indent=2)
+
+        with open(paths[1], "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+        return paths
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Results store: detections (pulse end times, decoded symbols, correlation
+peaks) and optionally the method/threshold series of each run, as Parquet
+datasets partitioned by recording date (UTC) and method. Rows are buffered
+and written in batches as new files, nothing is rewritten, so several
+processes can append to the same store. Queries read only the partitions
+and row groups their filters select.
+
+Needs pyarrow, imported on the first write or read.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import json
+import uuid
+import hashlib
+from time import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .core import _decoder
+from .cache import code_version
+
+# Columns of each dataset, date and method are the partitions
+SCHEMAS = {
+    "detections": (("date", "string"), ("method", "int8"), ("run", "string"), ("file", "string"),
+                   ("channel", "int16"), ("kind", "string"), ("time", "float64"), ("epoch", "float64"),
+                   ("symbol", "string"), ("score", "float64"), ("config", "string"), ("code", "string")),
+    "series": (("date", "string"), ("method", "int8"), ("run", "string"), ("file", "string"),
+               ("channel", "int16"), ("time", "float64"), ("epoch", "float64"), ("value", "float64"),
+               ("threshold", "float64"), ("detect", "int8"), ("config", "string"), ("code", "string")),
+}
+PARTITIONS = ["date", "method"]
+
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("The results store needs pyarrow: pip install pyarrow") from e
+
+    return pa, pq
+
+
+#######################################################
+# DETECTIONS
+#######################################################
+
+def recording_start(file, duration):
+
+    """
+    Start of a recording in seconds since the epoch (UTC), taken as the
+    modification time of the file minus its duration: the recorder writes
+    the file until the end of the recording. A copy that does not keep the
+    modification time (cp without -p) moves it.
+
+    Parameters:
+    file (str): recording
+    duration (float): length of the recording in seconds
+    """
+
+    return os.stat(file).st_mtime - duration
+
+
+def config_hash(config):
+
+    """
+    Short hash of a configuration, the same parameters give the same hash
+
+    Parameters:
+    config: JSON-serialisable parameters, e.g. dict or tuple
+    """
+
+    text = json.dumps(config, sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def symbol_times(detect_times, init_time, dict_msg, tolerance=None):
+
+    """
+    Decoded symbols with the pulse end time that closes each interval, the
+    symbols are the same as decode_times
+
+    Returns:
+    symbols (list): decoded symbols, empty with 2 pings or less
+    times (np.array): time of each symbol
+    """
+
+    detect_times = np.asarray(detect_times, dtype=float)
+    if len(detect_times) <= 2:
+        return [], np.empty(0)
+
+    decoder = _decoder(tuple(dict_msg.items()), init_time, tolerance)
+    code, count = decoder.match(np.diff(detect_times))
+
+    return decoder.symbols[np.repeat(code, count)].tolist(), np.repeat(detect_times[1:], count)
+
+
+def correlation_peaks(scores, times, min_score):
+
+    """
+    Local maxima of the ID correlation (first index of a plateau)
+
+    Parameters:
+    scores (list): correlation score, from correlate_id_vemco
+    times (np.array): time of each score
+    min_score (float): lowest score kept, e.g. the pulses of the ID
+
+    Returns:
+    times (np.array): time of each peak
+    scores (np.array): score of each peak
+    """
+
+    scores = np.asarray(scores, dtype=float)
+    times = np.asarray(times, dtype=float)[:len(scores)]
+    if len(scores) == 0:
+        return np.empty(0), np.empty(0)
+
+    padded = np.concatenate(([-np.inf], scores, [-np.inf]))
+    peak = (scores > padded[:-2]) & (scores >= padded[2:]) & (scores >= min_score)
+
+    return times[peak], scores[peak]
+
+
+#######################################################
+# STORE
+#######################################################
+
+class ResultStore:
+
+    """
+    Append-only Parquet store of detections and series
+
+        root/detections/date=2024-01-23/method=2/part-<writer>-<n>-0.parquet
+        root/series/...
+
+    Each row has the time in seconds from the start of its recording and,
+    when the start is given with the rows, the absolute time in seconds
+    since the epoch. The date partition is the UTC date of the recording
+    start, so queries select deployments by when they were recorded.
+
+    Parameters:
+    root (str): store folder, created if missing
+    batch_rows (int): rows buffered before they are written
+    date (str): date partition of every row, e.g. "2024-01-23", default the
+                recording date, today (UTC) for rows without a start
+    """
+
+    def __init__(self, root, batch_rows=1000000, date=None):
+        _arrow()  # Fail before the run, not at the first flush
+
+        self.root = root
+        self.batch_rows = batch_rows
+        self.date = date
+        self.run = uuid.uuid4().hex[:16]  # Rows of one store object, also names its files
+
+        self.pending = {name: [] for name in SCHEMAS}  # Column dicts per dataset
+        self.rows = {name: 0 for name in SCHEMAS}
+        self.parts = 0
+        os.makedirs(root, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _add(self, dataset, n, columns, info):
+        # Absolute times and date partition from the recording start
+        start = info.pop("start", None)
+        if start is not None:
+            columns["epoch"] = start + columns["time"]
+        date = self.date
+        if date is None:
+            date = datetime.fromtimestamp(time() if start is None else start, timezone.utc).strftime("%Y-%m-%d")
+
+        # Scalars (file, channel...) are repeated for the n rows
+        columns = {"date": date, "run": self.run, "code": code_version(), **info, **columns}
+
+        chunk = {}
+        for name, kind in SCHEMAS[dataset]:
+            value = np.asarray(columns.get(name), dtype=object if kind == "string" else None)  # None is null
+            chunk[name] = np.broadcast_to(value, n)
+
+        self.pending[dataset].append(chunk)
+        self.rows[dataset] += n
+
+        if self.rows[dataset] >= self.batch_rows:
+            self.flush(dataset)
+
+    def add_detections(self, kind, times, symbols=None, scores=None, **info):
+
+        """
+        Add detections of one kind
+
+        Parameters:
+        kind (str): "pulse", "symbol" or "peak"
+        times (np.array): time of each detection in seconds
+        symbols (list): decoded symbol of each detection (kind "symbol")
+        scores (np.array): score of each detection (kind "peak")
+        info: file, channel (-1 for the fused array), method, config and
+              start (recording start, see recording_start)
+        """
+
+        n = len(times)
+        if n == 0:
+            return
+
+        columns = {"kind": kind, "time": np.asarray(times, dtype=float)}
+        if symbols is not None:
+            columns["symbol"] = np.array([str(s) for s in symbols], dtype=object)
+        if scores is not None:
+            columns["score"] = np.asarray(scores, dtype=float)
+
+        self._add("detections", n, columns, info)
+
+    def add_series(self, times, values, threshold, detect, **info):
+
+        """
+        Add the method output, CFAR threshold and detection of one channel
+
+        Parameters:
+        times (np.array): time of each value
+        values (np.array): method output (normalised)
+        threshold (np.array): CFAR threshold
+        detect (np.array): 1 over the threshold
+        info: file, channel, method, config and start
+        """
+
+        columns = {"time": np.asarray(times, dtype=float), "value": np.asarray(values, dtype=float),
+                   "threshold": np.asarray(threshold, dtype=float), "detect": np.asarray(detect, dtype=np.int8)}
+
+        self._add("series", len(columns["time"]), columns, info)
+
+    def flush(self, dataset=None):
+
+        """
+        Write the buffered rows, of one dataset or all of them
+        """
+
+        pa, pq = _arrow()
+
+        for name in ([dataset] if dataset else SCHEMAS):
+            if not self.pending[name]:
+                continue
+
+            schema = pa.schema([(column, getattr(pa, kind)()) for column, kind in SCHEMAS[name]])
+            table = pa.table({column: pa.array(np.concatenate([chunk[column] for chunk in self.pending[name]]),
+                                               type=schema.field(column).type, from_pandas=True)
+                              for column in schema.names}, schema=schema)
+
+            # New files only, named after this writer, never over an existing one
+            pq.write_to_dataset(table, os.path.join(self.root, name), partition_cols=PARTITIONS,
+                                basename_template=f"part-{self.run}-{self.parts}-{{i}}.parquet",
+                                existing_data_behavior="overwrite_or_ignore")
+            self.parts += 1
+
+            self.pending[name] = []
+            self.rows[name] = 0
+
+    def close(self):
+        self.flush()
+
+    def read(self, dataset="detections", filters=None, columns=None):
+
+        """
+        Query a dataset
+
+        Parameters:
+        dataset (str): "detections" or "series"
+        filters (list): pyarrow filters, pushed down to the partitions and
+                        row groups, e.g. [("date", ">=", "2024-01-01"), ("kind", "=", "symbol")]
+        columns (list): columns to read, default all
+
+        Returns:
+        table (pyarrow.Table): to_pandas() or to_pydict() for the values
+        """
+
+        pa, pq = _arrow()
+        from pyarrow.dataset import partitioning
+
+        types = dict(SCHEMAS[dataset])
+        schema = pa.schema([(name, getattr(pa, types[name])()) for name in PARTITIONS])
+
+        return pq.read_table(os.path.join(self.root, dataset), filters=filters, columns=columns,
+                             partitioning=partitioning(schema, flavor="hive"))
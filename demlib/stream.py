@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming pipeline: the detection stages as objects that keep their
+carry-over state, fed buffer by buffer.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import numpy as np
+
+from .core import _cfar_guard, _cfar_cells, _check_pulse_run, _fuse_run, Decoder
+from .profiling import NULL_PROFILER
+
+
+#######################################################
+# STAGES
+#######################################################
+
+class NormalizeStage:
+
+    """
+    Normalise the method output to 0-1 with fixed bounds
+
+    A stream can not know the min/max of the whole recording, with the
+    bounds of the batch series the output is identical to normalize_0_1.
+
+    Parameters:
+    low (float): value mapped to 0, (channels, 1) array for bounds per channel
+    high (float): value mapped to 1
+    """
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def push(self, values):
+        return (np.asarray(values) - self.low) / (self.high - self.low)
+
+    def flush(self):
+        return np.empty(0)
+
+
+class RunningNormalizeStage:
+
+    """
+    Normalise the method output to 0-1 with the min/max seen so far
+
+    The first `warmup` values are held back to settle the bounds, then they
+    widen as new extremes arrive. For live streams without known bounds.
+    With (channels, n) values each channel keeps its own bounds.
+
+    Parameters:
+    warmup (int): values held before the first output
+    """
+
+    def __init__(self, warmup):
+        self.warmup = warmup
+        self.pending = []
+        self.count = 0
+        self.low = np.inf
+        self.high = -np.inf
+
+    def push(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.shape[-1]:
+            self.low = np.minimum(self.low, values.min(axis=-1, keepdims=True))
+            self.high = np.maximum(self.high, values.max(axis=-1, keepdims=True))
+        self.count += values.shape[-1]
+
+        if self.count < self.warmup:
+            self.pending.append(values)
+            return values[..., :0]
+
+        if self.pending:
+            values = np.concatenate(self.pending + [values], axis=-1)
+            self.pending = []
+
+        span = self.high - self.low
+        return (values - self.low) / np.where(span > 0, span, 1)
+
+    def flush(self):
+
+        """
+        End of stream, returns the values still held by the warm-up
+        """
+
+        self.warmup = 0
+        return self.push(self.pending[-1][..., :0] if self.pending else np.empty(0))
+
+
+class CfarStage:
+
+    """
+    CA-CFAR over a stream of method values, same as do_cfar_adapt (bias 0.05)
+    or do_cfar (bias 0)
+
+    An index is final once its leading reference cells have arrived, so the
+    stage has a latency of `cells + guard + 1` buffers and keeps at most
+    twice that in memory. (channels, n) values run every channel at once.
+
+    Parameters:
+    sample_rate (float): Sampling rate in Hz.
+    buffer_len (int): Samples per buffer.
+    pulse_width (int): width time of the pulse to calculate the guard time
+    cells (int): number of cells to calculate CFAR
+    bias (float): value subtracted to the threshold
+    mode (str): "ca", "go", "so" or "os" noise estimate
+    rank (float): order statistic for "os", 0 min, 1 max
+    """
+
+    def __init__(self, sample_rate, buffer_len, pulse_width, cells, bias=0.05, mode="ca", rank=0.75):
+        self.guard = _cfar_guard(sample_rate, buffer_len, pulse_width)
+        self.cells = cells
+        self.bias = bias
+        self.mode = mode
+        self.rank = rank
+
+        self.history = None  # Values from index `base` on
+        self.prefix = None  # Sum of the series before each history index
+        self.base = 0
+        self.done = 0  # Next index to emit
+
+    @property
+    def latency(self):
+        return self.cells + self.guard + 1
+
+    def push(self, values):
+
+        """
+        Add method values, returns threshold and detect of the indexes that
+        became final
+        """
+
+        values = np.asarray(values, dtype=float)
+        if self.history is None:
+            self.history = np.empty(values.shape[:-1] + (0,))
+            self.prefix = np.zeros(values.shape[:-1] + (1,))
+        if values.shape[-1] == 0:
+            values = self.history[..., :0]
+
+        # Carry on the running sum, same bits as the cumsum of the whole series
+        carried = np.cumsum(np.concatenate((self.prefix[..., -1:], values), axis=-1), axis=-1)
+        self.history = np.concatenate((self.history, values), axis=-1)
+        self.prefix = np.concatenate((self.prefix, carried[..., 1:]), axis=-1)
+        length = self.base + self.history.shape[-1]
+
+        return self._emit(length - self.cells - self.guard, length)
+
+    def flush(self):
+
+        """
+        End of stream, returns threshold and detect of the remaining indexes
+        """
+
+        if self.history is None:
+            return np.empty(0), np.empty(0, dtype=int)
+
+        length = self.base + self.history.shape[-1]
+
+        return self._emit(length, length)
+
+    def _emit(self, stop, length):
+        start = self.done
+        if stop <= start:
+            return self.history[..., :0], self.history[..., :0].astype(int)
+
+        threshold = _cfar_cells(self.history, start, stop, length, self.guard, self.cells,
+                                base=self.base, prefix=self.prefix, mode=self.mode, rank=self.rank)
+        threshold = threshold - self.bias
+        detect = (self.history[..., (start - self.base):(stop - self.base)] > threshold).astype(int)
+        self.done = stop
+
+        # Forget the values out of the lagging reference cells
+        keep = max(self.done - self.guard - self.cells, self.base)
+        self.history = self.history[..., (keep - self.base):]
+        self.prefix = self.prefix[..., (keep - self.base):]
+        self.base = keep
+
+        return threshold, detect
+
+
+class PulseStage:
+
+    """
+    Pulse width check over a stream of detections, same as do_check_pulse
+
+    The first detection is compared with an idle (0) previous value instead
+    of the last one of the recording. Both give the same result as long as
+    the pulse width is wider than the 2 ms tolerance.
+
+    Parameters:
+    sample_rate (float): Sampling rate in Hz.
+    buffer_length (int): Samples per buffer.
+    pulse_width (int): width time of the pulse in ms
+    """
+
+    def __init__(self, sample_rate, buffer_length, pulse_width):
+        self.time_buf = buffer_length/sample_rate
+        self.pulse_width = pulse_width/1000
+
+        self.state = (0, 0, 0, -1)  # prev, up_ant, up, last detect time
+        self.index = 0
+
+    def push(self, detect):
+
+        """
+        Add detections, returns the -1/1 pulse check and the pulse end times
+        """
+
+        pulse, times, _, self.state = _check_pulse_run(detect, self.index, self.state, self.time_buf, self.pulse_width)
+        self.index += len(detect)
+
+        return pulse, times
+
+
+class DecodeStage:
+
+    """
+    Decode the time between pulse ends as they arrive, same as decode_times
+
+    Parameters:
+    init_time (float in seconds): Typically 0.340 when vemco
+    dict_msg (dictionary): change from decoded times to msg decoding
+    tolerance (float in seconds): Max distance to a code, default 5 ms
+    """
+
+    def __init__(self, init_time, dict_msg, tolerance=None):
+        self.decoder = Decoder(dict_msg, init_time, tolerance)
+
+        self.last = None
+        self.pings = 0
+        self.pending = []  # decode_times needs more than 2 pings
+
+    def push(self, times):
+
+        """
+        Add pulse end times, returns the decoded symbols
+        """
+
+        if len(times) == 0:
+            return []
+
+        previous = [] if self.last is None else [self.last]
+        msg = self.decoder.decode_intervals(np.diff(previous + list(times)))
+        self.last = times[-1]
+        self.pings += len(times)
+
+        if self.pings <= 2:
+            self.pending += msg
+            return []
+
+        msg = self.pending + msg
+        self.pending = []
+
+        return msg
+
+
+class FusionStage:
+
+    """
+    k-of-n vote of the pulse end times of the channels, same as fuse_times
+
+    A coincidence group is final once every channel has been checked past
+    its first time plus the window.
+
+    Parameters:
+    n_channels (int): channels of the array
+    k (int): channels that must detect a pulse
+    window (float in seconds): max spread of the arrivals of one pulse
+    """
+
+    def __init__(self, n_channels, k=1, window=0.01):
+        self.n_channels = n_channels
+        self.k = k
+        self.window = window
+
+        self.times = np.empty(0)
+        self.channels = np.empty(0, dtype=int)
+
+    def push(self, detect_times, now):
+
+        """
+        Add the pulse end times of each channel, all the channels checked up
+        to `now` seconds. Returns the fused pulses that became final
+        """
+
+        self.times = np.concatenate([self.times] + [np.asarray(t, dtype=float) for t in detect_times])
+        self.channels = np.concatenate([self.channels] + [np.full(len(t), c) for c, t in enumerate(detect_times)])
+
+        events, (self.times, self.channels) = _fuse_run(self.times, self.channels, self.n_channels, self.k,
+                                                        self.window, now)
+
+        return events
+
+    def flush(self):
+
+        """
+        End of stream, returns the remaining fused pulses
+        """
+
+        return self.push([[]] * self.n_channels, np.inf)
+
+
+#######################################################
+# ENGINE
+#######################################################
+
+class StreamEngine:
+
+    """
+    Chain the stages: method -> normalisation -> CFAR -> pulse check -> decode
+
+    Parameters:
+    method (callable): maps a (n_buffers, buffer_len) matrix to one value
+                       per buffer, e.g. lambda b: dm.do_goertzel(b, 150000, 69000)
+    normalize (NormalizeStage, RunningNormalizeStage or None)
+    cfar (CfarStage)
+    pulse (PulseStage)
+    decode (DecodeStage)
+    profiler (Profiler): time of each stage, default none
+    """
+
+    def __init__(self, method, normalize, cfar, pulse, decode, profiler=NULL_PROFILER):
+        self.method = method
+        self.normalize = normalize
+        self.cfar = cfar
+        self.pulse = pulse
+        self.decode = decode
+        self.profiler = profiler
+
+    def feed(self, buffer):
+
+        """
+        Process a block of buffers
+
+        Returns:
+        detect_times (list): pulse end times that became final
+        msg (list): decoded symbols that became final
+        """
+
+        n = np.shape(buffer)[-2]
+        with self.profiler.stage("method", n):
+            values = self.method(buffer)
+        if self.normalize is not None:
+            with self.profiler.stage("normalize", n):
+                values = self.normalize.push(values)
+
+        with self.profiler.stage("cfar", n):
+            cfar_out = self.cfar.push(values)
+
+        return self._detect(cfar_out)
+
+    def close(self):
+
+        """
+        End of stream, returns the remaining detect_times and msg
+        """
+
+        times, msg = [], []
+        if self.normalize is not None:
+            times, msg = self._detect(self.cfar.push(self.normalize.flush()))
+
+        last_times, last_msg = self._detect(self.cfar.flush())
+
+        return times + last_times, msg + last_msg
+
+    def run(self, buffers):
+
+        """
+        Process all the buffer blocks, returns pings and msg like decode_times
+        """
+
+        msg = []
+        for buffer in buffers:
+            msg += self.feed(buffer)[1]
+        msg += self.close()[1]
+
+        if self.decode.pings <= 2:
+            msg = "Not enough data"
+
+        return self.decode.pings, msg
+
+    def _detect(self, cfar_out):
+        _, detect = cfar_out
+        with self.profiler.stage("pulse", len(detect)):
+            _, times = self.pulse.push(detect)
+
+        with self.profiler.stage("decode", len(times)):
+            return times, self.decode.push(times)
+
+
+class ArrayEngine(StreamEngine):
+
+    """
+    StreamEngine for a hydrophone array: the method, normalisation and CFAR
+    run on all the channels at once, the pulse check on each channel, and
+    the fused pulses are decoded
+
+    Parameters:
+    method (callable): maps a (channels, n_buffers, buffer_len) block to
+                       (channels, n_buffers) values, e.g.
+                       lambda b: dm.do_goertzel(b, 150000, 69000)
+    normalize (NormalizeStage, RunningNormalizeStage or None)
+    cfar (CfarStage)
+    pulse (list of PulseStage): one per channel
+    fusion (FusionStage)
+    decode (DecodeStage)
+    profiler (Profiler): time of each stage, default none
+    """
+
+    def __init__(self, method, normalize, cfar, pulse, fusion, decode, profiler=NULL_PROFILER):
+        super().__init__(method, normalize, cfar, pulse, decode, profiler)
+        self.fusion = fusion
+
+    def close(self):
+
+        """
+        End of stream, returns the remaining fused pulses and msg
+        """
+
+        events, msg = super().close()
+        last = self.fusion.flush()
+
+        return events + last, msg + self.decode.push([e["time"] for e in last])
+
+    def _detect(self, cfar_out):
+        # Fused pulses (dicts, see fuse_times) instead of pulse end times
+        _, detect = cfar_out
+        with self.profiler.stage("pulse", np.size(detect)):
+            times = [stage.push(channel)[1] for stage, channel in zip(self.pulse, detect)]
+        now = self.cfar.done * self.pulse[0].time_buf
+
+        with self.profiler.stage("fusion", sum(len(t) for t in times)):
+            events = self.fusion.push(times, now)
+
+        with self.profiler.stage("decode", len(events)):
+            return events, self.decode.push([e["time"] for e in events])
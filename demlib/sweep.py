@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweep: every configuration of a grid is a chain of pipeline
+stages (read -> downsample -> buffers -> method -> detect), each stage keyed
+by the parameters it depends on. Configurations that share a key share the
+intermediate, which is computed once and kept in an LRU cache. Over several
+processes the shared arrays go through the on-disk cache and are
+memory-mapped by the workers.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import shutil
+import tempfile
+from itertools import product
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .cache import ArrayCache, array_hash
+from .core import open_wav, do_downsample_float, do_buffers, do_fft, do_goertzel, do_filter, do_sdft, \
+    do_check_pulse, decode_times
+from .utils import normalize_0_1
+from .indev import do_cfar_adapt
+
+# Same defaults as main.py
+SWEEP_DEFAULTS = {
+    "input": "docs/1.wav",
+    "sampleRate": 150000,
+    "buffer": 256,
+    "method": 1,
+    "numeric": "float64",
+    "hop": 64,
+    "goertzel": (69000,),
+    "onFreq": 68000,
+    "offFreq": 70000,
+    "filterFrequency": 69000,
+    "localOscillator": 58000,
+    "pulseWidth": 5,
+    "cells": None,  # main.py reference time, buffer*10 values
+    "cfar": "ca",
+    "rank": 0.75,
+    "tolerance": 5,
+}
+
+STAGES = ("read", "down", "buffers", "method", "detect")
+DISK_STAGES = ("down", "buffers", "method")  # Arrays worth an on-disk cache
+UPSTREAM = ("read", "down", "buffers")  # Stages before the method, shared by most of a grid
+
+
+#######################################################
+# GRID
+#######################################################
+
+def expand_grid(grid, defaults=SWEEP_DEFAULTS):
+
+    """
+    Configurations of a parameter grid
+
+    Parameters:
+    grid (dict): parameter name -> list of values, names as main.py options
+    defaults (dict): value of the parameters not in the grid
+
+    Returns:
+    configs (list of dict): one per combination, in grid order
+    """
+
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {', '.join(sorted(unknown))}")
+
+    names = list(grid)
+    configs = []
+    for values in product(*(grid[name] for name in names)):
+        config = dict(defaults, **dict(zip(names, values)))
+        if np.ndim(config["goertzel"]) == 0:
+            config["goertzel"] = (config["goertzel"],)
+        config["goertzel"] = tuple(config["goertzel"])
+        configs.append(config)
+
+    return configs
+
+
+def stage_keys(config):
+
+    """
+    Key of each stage of a configuration, the parameters it depends on plus
+    the key of the stage before
+
+    Returns:
+    keys (list): (stage, key) from read to detect
+    """
+
+    c = config
+    read = ("read", c["input"])
+    down = read + (c["sampleRate"],)
+
+    detection = (c["pulseWidth"], c["cells"], c["cfar"], c["rank"], c["tolerance"])
+
+    # Sliding Goertzel works on the downsampled samples, no buffers stage
+    if c["method"] == 4:
+        method = down + (4, c["buffer"], c["hop"], c["goertzel"])
+        return [("read", read), ("down", down), ("method", method), ("detect", method + detection)]
+
+    params = {1: (c["onFreq"], c["offFreq"]),
+              2: (c["goertzel"],),
+              3: (c["filterFrequency"], c["localOscillator"])}.get(c["method"])
+    if params is None:
+        raise ValueError(f"Invalid method {c['method']}")
+
+    buffers = down + (c["buffer"],)
+    method = buffers + (c["method"], c["numeric"]) + params
+
+    return list(zip(STAGES, (read, down, buffers, method, method + detection)))
+
+
+def _disk_params(stage, config, key, coefficients):
+    # Key of a stage without the input file, plus the filter coefficients of method 3
+    params = key[2:]
+    if stage == "method" and config["method"] == 3 and coefficients is not None:
+        params += (array_hash(*coefficients),)
+    return params
+
+
+def method_key(args, coefficients=None):
+
+    """
+    Parameters the method output depends on, from the main.py arguments
+
+    Parameters:
+    args (Namespace): main.py arguments
+    coefficients (tuple): anti-aliasing and band-pass coefficients, method 3
+    """
+
+    config = expand_grid({}, {name: getattr(args, name, value) for name, value in SWEEP_DEFAULTS.items()})[0]
+
+    return _disk_params("method", config, dict(stage_keys(config))["method"], coefficients)
+
+
+#######################################################
+# STAGES
+#######################################################
+
+def _run_stage(stage, config, value, dict_msg, coefficients):
+    c = config
+
+    if stage == "read":
+        return open_wav(c["input"])
+
+    if stage == "down":
+        sample_rate, samples = value
+        return do_downsample_float(samples, c["sampleRate"], sample_rate / c["sampleRate"])[0]
+
+    if stage == "buffers":
+        return do_buffers(value, c["buffer"], c["sampleRate"])[0]
+
+    if stage == "method":
+        if c["method"] == 1:
+            return do_fft(value, c["sampleRate"], c["onFreq"], c["offFreq"], fmt=c["numeric"])[0]
+        if c["method"] == 2:
+            return do_goertzel(value, c["sampleRate"], list(c["goertzel"]), fmt=c["numeric"]).max(axis=1)
+        if c["method"] == 3:
+            if coefficients is None:
+                raise ValueError("Method 3 needs the filter coefficients")
+            return do_filter(value, c["sampleRate"], c["filterFrequency"], c["localOscillator"], *coefficients,
+                             fmt=c["numeric"])
+        return do_sdft(value, c["sampleRate"], list(c["goertzel"]), c["buffer"], c["hop"])[0].max(axis=1)
+
+    # Detect and decode, as main.py
+    step = c["hop"] if c["method"] == 4 else c["buffer"]
+    cells = c["cells"] if c["cells"] is not None else c["buffer"]*10*c["buffer"]//step
+    _, detect = do_cfar_adapt(normalize_0_1(value), c["sampleRate"], step, c["pulseWidth"], cells, c["cfar"], c["rank"])
+    _, detect_times = do_check_pulse(detect, c["sampleRate"], step, c["pulseWidth"])
+
+    return decode_times(detect_times, 0.339, dict_msg, c["tolerance"]/1000)
+
+
+class StageCache:
+
+    """
+    LRU cache of stage outputs with a memory budget
+
+    Memory-mapped arrays (the WAV file) do not count to the budget.
+
+    Parameters:
+    budget (int): max bytes of the cached arrays
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.items = OrderedDict()
+        self.used = 0
+
+    @staticmethod
+    def size(value):
+        values = value if isinstance(value, tuple) else (value,)
+        return sum(v.nbytes for v in values if isinstance(v, np.ndarray) and not isinstance(v, np.memmap))
+
+    def get(self, key):
+        self.items.move_to_end(key)
+        return self.items[key][0]
+
+    def put(self, key, value):
+        size = self.size(value)
+        if size > self.budget:
+            return
+
+        self.items[key] = (value, size)
+        self.used += size
+        while self.used > self.budget:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.used -= evicted
+
+
+def _run_group(configs, dict_msg, coefficients, memory, disk, upstream=False):
+
+    """
+    Run configurations sharing upstream stages in one process, the array
+    stages also go through the on-disk cache when there is one
+
+    Parameters:
+    upstream (bool): run only the stages before the method, their output
+                     is left in the disk cache for the workers
+
+    Returns:
+    results (list): (pings, msg) per configuration, None with upstream
+    runs (dict): stage -> number of times it was computed
+    """
+
+    cache = StageCache(memory)
+    runs = dict.fromkeys(STAGES, 0)
+    results = []
+
+    for config in configs:
+        chain = stage_keys(config)
+        if upstream:
+            chain = [(stage, key) for stage, key in chain if stage in UPSTREAM]
+        disk_keys = {stage: disk.key(config["input"], stage, _disk_params(stage, config, key, coefficients))
+                     for stage, key in chain if stage in DISK_STAGES} if disk is not None else {}
+
+        # Deepest stage already computed, in memory or on disk
+        start, value = 0, None
+        for i in range(len(chain) - 1, -1, -1):
+            stage, key = chain[i]
+            if key in cache.items:
+                start, value = i + 1, cache.get(key)
+                break
+
+            arrays = disk.load(disk_keys[stage]) if stage in disk_keys else None
+            if arrays is not None:
+                start, value = i + 1, arrays[0]
+                cache.put(key, value)
+                break
+
+        for stage, key in chain[start:]:
+            value = _run_stage(stage, config, value, dict_msg, coefficients)
+            runs[stage] += 1
+            if stage in disk_keys:
+                disk.save(disk_keys[stage], value)
+            cache.put(key, value)
+
+        results.append(None if upstream else value)
+
+    return results, runs
+
+
+def _map(pool, tasks, dict_msg, coefficients, memory, disk, upstream=False):
+    # _run_group over lists of configurations, in the pool or in this process
+    n = len(tasks)
+    args = (tasks, [dict_msg]*n, [coefficients]*n, [memory]*n, [disk]*n, [upstream]*n)
+
+    if pool is None or n == 1:
+        return list(map(_run_group, *args))
+
+    return list(pool.map(_run_group, *args))
+
+
+#######################################################
+# SWEEP
+#######################################################
+
+def run_sweep(grid, dict_msg, coefficients=None, workers=1, memory=512*2**20, cache=None):
+
+    """
+    Run the detection pipeline over a parameter grid
+
+    The configurations are sorted so the ones sharing stages run one after
+    the other. In one process they all go through one stage cache. With
+    several workers the stages before the method run first, one task per
+    recording and sample rate, and their arrays are left in the disk cache
+    (a temporary one if none is given). Then each set of configurations
+    sharing a method output is a task, the workers memory-map the shared
+    input instead of computing it again.
+
+    Parameters:
+    grid (dict): parameter name -> list of values, see SWEEP_DEFAULTS
+    dict_msg (dictionary): change from decoded times to msg decoding
+    coefficients (tuple): anti-aliasing and band-pass coefficients, method 3
+    workers (int): processes, 1 runs in this process
+    memory (int): stage cache budget in bytes, per process
+    cache (ArrayCache): on-disk cache of the array stages, optional
+
+    Returns:
+    results (list of dict): the configuration plus pings and msg, in grid order
+    runs (dict): stage -> number of times it was computed, not loaded from cache
+    """
+
+    configs = expand_grid(grid)
+    keys = [stage_keys(config) for config in configs]
+    order = sorted(range(len(configs)), key=lambda i: repr([key for _, key in keys[i]]))
+
+    def group_by(stage):
+        groups = {}
+        for i in order:
+            groups.setdefault(dict(keys[i])[stage], []).append(i)
+        return list(groups.values())
+
+    runs = dict.fromkeys(STAGES, 0)
+    results = [None]*len(configs)
+
+    def collect(groups, outputs):
+        for group, (group_results, group_runs) in zip(groups, outputs):
+            for i, value in zip(group, group_results):
+                if value is not None:
+                    pings, msg = value
+                    results[i] = dict(configs[i], pings=pings, msg=msg)
+            for stage in STAGES:
+                runs[stage] += group_runs[stage]
+
+    if workers == 1:
+        groups = [order]
+        collect(groups, _map(None, [[configs[i] for i in order]], dict_msg, coefficients, memory, cache))
+        return results, runs
+
+    # Shared arrays between the processes, through the disk
+    folder = None
+    if cache is None:
+        folder = tempfile.mkdtemp(prefix="sweep-")
+        cache = ArrayCache(folder, max_bytes=float("inf"))
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            groups = group_by("down")
+            collect(groups, _map(pool, [[configs[i] for i in group] for group in groups],
+                                 dict_msg, coefficients, memory, cache, upstream=True))
+
+            groups = group_by("method")
+            collect(groups, _map(pool, [[configs[i] for i in group] for group in groups],
+                                 dict_msg, coefficients, memory, cache))
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return results, runs
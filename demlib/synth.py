@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic PPM recordings: Vemco-style pulse trains over a carrier with
+controlled SNR, noise type and multipath, reproducible by seed.
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import numpy as np
+
+NOISE_TYPES = ("white", "pink", "impulsive")
+
+
+#######################################################
+# PULSE TRAIN
+#######################################################
+
+def ppm_train(msg, dict_msg, duration, start=1.0, gap=2.0, init_time=0.34, unit=0.01):
+
+    """
+    Pulse end times of a message repeated along a recording
+
+    Parameters:
+    msg (list): symbols after the init pulse, e.g. [355, 495, 415]
+    dict_msg (dictionary): code -> symbol, codes in `unit` steps, e.g. dict_vemco
+    duration (float in seconds): recording length, only complete messages are placed
+    start (float in seconds): end of the first pulse
+    gap (float in seconds): silence between the last pulse and the next message
+    init_time (float in seconds): Init interval, typically 0.340 when vemco
+    unit (float in seconds): Time of one code step, 0.01 s (10 ms) for vemco
+
+    Returns:
+    ends (np.array): pulse end times in seconds
+    """
+
+    codes = {symbol: code for code, symbol in dict_msg.items()}
+    intervals = [init_time] + [codes[symbol]*unit for symbol in msg]
+    offsets = np.concatenate(([0], np.cumsum(intervals)))
+
+    ends = []
+    t = start
+    while t + offsets[-1] < duration:
+        ends.append(t + offsets)
+        t += offsets[-1] + gap
+
+    return np.concatenate(ends) if ends else np.empty(0)
+
+
+#######################################################
+# SIGNAL
+#######################################################
+
+def _noise(kind, n, rng):
+    if kind == "white":
+        return rng.standard_normal(n)
+
+    if kind == "pink":
+        # 1/f power, unit variance
+        spectrum = np.fft.rfft(rng.standard_normal(n))
+        f = np.arange(len(spectrum))
+        f[0] = 1
+        noise = np.fft.irfft(spectrum / np.sqrt(f), n)
+        return noise / np.std(noise)
+
+    if kind == "impulsive":
+        # Gaussian background plus sparse clicks (snapping shrimp), unit variance
+        noise = rng.standard_normal(n)
+        clicks = rng.random(n) < 1e-4
+        noise[clicks] += rng.standard_normal(clicks.sum()) * 30
+        return noise / np.std(noise)
+
+    raise ValueError(f"Unknown noise type {kind}, one of {', '.join(NOISE_TYPES)}")
+
+
+def synth_ppm(sample_rate, ends, snr_db, duration, carrier=69000, pulse_width=5, noise="white",
+              multipath=(), noise_counts=1000, seed=None):
+
+    """
+    ADC recording of a PPM pulse train
+
+    Parameters:
+    sample_rate (float): Sampling rate in Hz.
+    ends (np.array): pulse end times in seconds, see ppm_train
+    snr_db (float): pulse power over noise power in the full band, in dB
+    duration (float in seconds): recording length
+    carrier (float): pulse frequency in Hz
+    pulse_width (int): width time of the pulse in ms
+    noise (str): "white", "pink" or "impulsive"
+    multipath (list): (delay in seconds, gain) of each echo
+    noise_counts (float): noise standard deviation in ADC counts
+    seed (int): random seed
+
+    Returns:
+    samples (np.array int16): recording in ADC counts
+    """
+
+    rng = np.random.default_rng(seed)
+    n = int(duration*sample_rate)
+    amplitude = noise_counts * np.sqrt(2 * 10**(snr_db/10))
+
+    signal = noise_counts * _noise(noise, n, rng)
+
+    width = int(pulse_width*sample_rate/1000)
+    for delay, gain in ((0, 1),) + tuple(multipath):
+        phase = rng.uniform(0, 2*np.pi, len(ends))  # Random carrier phase per pulse and path
+        first = np.round((np.asarray(ends) + delay)*sample_rate).astype(int) - width
+        keep = (first >= 0) & (first + width <= n)
+
+        index = first[keep, None] + np.arange(width)
+        signal[index] += gain * amplitude * np.sin(2*np.pi*carrier*index/sample_rate + phase[keep, None])
+
+    return np.clip(np.round(signal), -32768, 32767).astype(np.int16)
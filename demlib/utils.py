@@ -2,15 +2,20 @@ import numpy as np
 
 # NORMALIZATION
 
+# Along the last axis, each channel of a (channels, n) array on its own
+
 def normalize_0_1(data):
-    return (data - np.min(data)) / (np.max(data) - np.min(data))
+    low, high = np.min(data, axis=-1, keepdims=True), np.max(data, axis=-1, keepdims=True)
+    return (data - low) / (high - low)
 
 def normalize_neg1_1(data):
-    return 2 * (data - np.min(data)) / (np.max(data) - np.min(data)) - 1
+    low, high = np.min(data, axis=-1, keepdims=True), np.max(data, axis=-1, keepdims=True)
+    return 2 * (data - low) / (high - low) - 1
 
 
 def normalize_custom(data, a, b):
-    return a + (data - np.min(data)) * (b - a) / (np.max(data) - np.min(data))
+    low, high = np.min(data, axis=-1, keepdims=True), np.max(data, axis=-1, keepdims=True)
+    return a + (data - low) * (b - a) / (high - low)
 
 # DOWNSAMPLING
 
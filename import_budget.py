@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Import-time budget: imports demlib and the command-line scripts in fresh
+interpreters with -X importtime, compares the median with a budget and
+checks that no heavy module (scipy, matplotlib) is loaded at start-up.
+Exits with 1 on a regression, e.g. in CI
+
+    python import_budget.py
+    python import_budget.py -t demlib:30 main:200 -r 9
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+# IMPORTS
+import os
+import sys
+import subprocess
+from statistics import median
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+#######################################################
+# MEASURE
+#######################################################
+
+def import_time(module, forbidden):
+
+    """
+    Import `module` in a fresh interpreter
+
+    Returns:
+    total (float): import time of the module in ms
+    imports (list): (self ms, cumulative ms, name) of every module imported
+    loaded (list): forbidden modules found in sys.modules afterwards
+    """
+
+    code = (f"import sys, {module}\n"
+            f"print(' '.join(m for m in sys.modules if m.split('.')[0] in {tuple(forbidden)!r}))")
+    run = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, capture_output=True,
+                         text=True, check=True)
+
+    imports = []
+    for line in run.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(self_us) / 1000, int(cumulative_us) / 1000, name.strip()))
+
+    total = next(cumulative for _, cumulative, name in reversed(imports) if name == module)
+
+    return total, imports, run.stdout.split()
+
+
+def check(targets, runs, forbidden, top):
+
+    """
+    Measure every target, `runs` times each
+
+    Returns:
+    ok (bool): every target within its budget and without forbidden modules
+    """
+
+    ok = True
+    print(f"{'module':<12}{'median ms':>10}{'budget ms':>10}  status")
+
+    for module, budget in targets:
+        times = []
+        for _ in range(runs):
+            total, imports, loaded = import_time(module, forbidden)
+            times.append(total)
+
+        status = "ok"
+        if median(times) > budget:
+            status = "OVER BUDGET"
+        if loaded:
+            status = f"LOADS {' '.join(sorted(set(m.split('.')[0] for m in loaded)))}"
+        print(f"{module:<12}{median(times):>10.1f}{budget:>10.1f}  {status}")
+
+        # Where the time goes, slowest modules of the last run
+        if status != "ok":
+            ok = False
+            for self_ms, cumulative_ms, name in sorted(imports, key=lambda i: -i[0])[:top]:
+                print(f"    {self_ms:>8.1f} ms self {cumulative_ms:>8.1f} ms cumulative  {name}")
+
+    return ok
+
+
+# MAIN
+
+def main(args):
+    targets = []
+    for target in args.targets:
+        module, budget = target.split(":")
+        targets.append((module, float(budget)))
+
+    ok = check(targets, args.runs, args.forbidden, args.top)
+    print("Import budget ok" if ok else "Import budget exceeded")
+
+    return ok
+
+
+if __name__ == "__main__":
+
+    # INIT
+    argparser = ArgumentParser()
+
+    # BUDGET
+    argparser.add_argument("-t", "--targets", help="Modules as module:ms, default demlib:50 main:400 realtime:400", type=str, nargs="+", default=["demlib:50", "main:400", "realtime:400"])
+    argparser.add_argument("-r", "--runs", help="Fresh imports per module, the median is compared, default 5", type=int, default=5)
+    argparser.add_argument("-fb", "--forbidden", help="Packages that must not load at import, default scipy matplotlib", type=str, nargs="*", default=["scipy", "matplotlib"])
+
+    # OUTPUT
+    argparser.add_argument("-top", "--top", help="Slowest modules listed on a failure, default 10", type=int, default=10)
+
+    # EXIT
+    args = argparser.parse_args()
+
+    try:
+        sys.exit(0 if main(args) else 1)
+
+    except KeyboardInterrupt:
+        print("Program terminated by user.")
@@ -8,7 +8,9 @@ created: 23/01/2024
 """
 
 # IMPORTS
+import os
 import sys
+from time import perf_counter
 
 import demlib as dm
 from docs.filter_coefficients import coefficients_antialiassing, coefficients_bandpass
@@ -16,19 +18,35 @@ from docs.decode_lists import dict_vemco
 
 
 from argparse import ArgumentParser
-import matplotlib.pyplot as plt
-
-plt.rcParams.update({
-    "text.usetex": True
-})
+import numpy as np
 
 # MAIN
 
-def main(args):
+def main(args, timings=None, profiler=None, store=None):
+
+    # Results store, opened here so a missing pyarrow fails before the run, and
+    # closed also when the run fails so the buffered rows are written
+    if store is None and args.store:
+        with dm.ResultStore(args.store) as store:
+            return run(args, timings, profiler, store)
+
+    return run(args, timings, profiler, store)
+
+
+def run(args, timings=None, profiler=None, store=None):
 
     #######################################################
     # VARIABLES
     #######################################################
+    if timings is None:
+        timings = {}  # Seconds per stage, filled for the batch runner
+    t0 = perf_counter()
+
+    # Stage profile, written here unless the caller (batch) collects it
+    save_profile = profiler is None and args.profile
+    if profiler is None:
+        profiler = dm.Profiler(args.profileMemory) if args.profile else dm.NULL_PROFILER
+
     if args.output:
         sys.stdout = open("docs/log.txt", "w")
 
@@ -39,35 +57,100 @@ def main(args):
     #######################################################
     # READ DATA
     #######################################################
-    sample_rate, samples, time_wav = dm.read_wav(args.input)  # Samples in counts
+    # Samples in counts, memory-mapped. Logic-analyzer CSV captures are converted
+    # once to a binary cache, in the units of the capture
+    if args.input.lower().endswith(".csv"):
+        sample_rate, samples = dm.open_csv(args.input, args.csvColumn, args.csvTime or None)
+    else:
+        sample_rate, samples = dm.open_wav(args.input)
     print(f"Input file: {args.input}")
 
+    # Hydrophone array, all the channels processed at once
+    if samples.ndim == 2:
+        samples = samples.T  # (channels, n_samples) view
+        print(f"Channels: {len(samples)}")
+
     #######################################################
     # EMULATE ADC OPERATIVE
     #######################################################
 
-    # DownSample
+    # Read in blocks, DownSample and create buffers
     factor = sample_rate / args.sampleRate
-    samples_down, times_down = dm.do_downsample_float(samples, args.sampleRate, factor)
-
-    # Create buffers
-    buffer, buf_times = dm.do_buffers(samples_down, args.buffer, args.sampleRate)
-
+    block_items = lambda block: block[1].shape[-1]
+    blocks = profiler.iterate("read", dm.iter_blocks(samples, args.block), block_items)
+    blocks_down = profiler.iterate("downsample", dm.do_downsample_blocks(blocks, factor), block_items)
+
+    # Sliding Goertzel works on the downsampled samples, one value per hop
+    if args.method == 4:
+        buffers = dm.do_sdft_blocks(blocks_down, args.sampleRate, args.goertzel, args.buffer, args.hop)
+        step = args.hop
+    else:
+        buffers = dm.do_buffers_blocks(blocks_down, args.buffer, args.sampleRate)
+        step = args.buffer
+    buffers = profiler.iterate("buffers", buffers, lambda buffer: len(buffer[1]))
+
+    # Method output already cached, skip the DSP front end
+    cached = None
+    if args.cache:
+        cache = dm.ArrayCache(args.cache, args.cacheSize*2**20)
+        cache_key = cache.key(args.input, "method", method_params(args))
+        cached = cache.load(cache_key)
+        if cached is not None:
+            buffers = []
 
     #######################################################
     # PROCESS THE BUFFERS
     #######################################################
 
     method_res_norm = []
+    filter_state = {}  # LO phase and FIR memory carried between blocks
+
+    for buffer, buf_times in buffers:
+        with profiler.stage("method", len(buf_times)):
+
+            # FFT
+            if args.method == 1:
+                res, lb, ub = dm.do_fft(buffer, args.sampleRate, args.onFreq, args.offFreq, workers=args.fftWorkers, fmt=args.numeric)
+
+            # Goertzel
+            elif args.method == 2:
+                res = dm.do_goertzel(buffer, args.sampleRate, args.goertzel, fmt=args.numeric).max(axis=-1)
+
+            # Filtering
+            elif args.method == 3:
+                res = dm.do_filter(buffer,args.sampleRate, args.filterFrequency, args.localOscillator, coefficients_antialiassing, coefficients_bandpass, state=filter_state, fmt=args.numeric)
+
+            # Sliding Goertzel, buffer already holds the power of each window
+            elif args.method == 4:
+                res = buffer.max(axis=-1)
+
+            else:
+                break
+
+        method_res.append(res)
+        method_times.append(buf_times)
+
+    if cached is not None:
+        method_res, method_times = cached[:2]
+        if args.method == 1:
+            lb, ub = cached[2]
+
+    elif method_res:
+        method_res = np.concatenate(method_res, axis=-1)
+        method_times = np.concatenate(method_times)
+        if args.cache:
+            cache.save(cache_key, method_res, method_times, *([[lb, ub]] if args.method == 1 else []))
+
+    if len(method_res):
+        with profiler.stage("normalize", np.shape(method_res)[-1]):
+            method_res_norm = dm.normalize_0_1(method_res)
+
+    timings["process"] = perf_counter() - t0  # Read, ADC emulation and method, streamed together
 
     # FFT
     if args.method == 1:
 
-        method_res, lb, ub = dm.do_fft(buffer, args.sampleRate, args.onFreq, args.offFreq)
-        method_res_norm = dm.normalize_0_1(method_res)
-        method_times = buf_times
-
-        method = r"\bf{FFT}"
+        method = "FFT"
         print("Method: FFT")
         print(f"Set frequency bandpass: {args.onFreq} -{args.offFreq} Hz ")
         print(f"Real frequency bandpass: {lb}-{ub} Hz ")
@@ -75,25 +158,24 @@ def main(args):
     # Goertzel
     elif args.method == 2:
 
-        method_res = dm.do_goertzel(buffer, args.sampleRate, args.goertzel)
-        method_res_norm = dm.normalize_0_1(method_res)
-        method_times = buf_times
-
-        method = r"\bf{GOERTZEL}"
+        method = "GOERTZEL"
         print("Method: GOERTZEL")
-        print(f"Center set frequency: {args.goertzel} Hz ")
+        print(f"Center set frequency: {', '.join(str(f) for f in args.goertzel)} Hz ")
         print(f"Frequency bin width: {args.sampleRate/(args.buffer*2)} Hz ")
 
 
     # Filtering
     elif args.method == 3:
-        method_res = dm.do_filter(buffer,args.sampleRate, args.filterFrequency, args.localOscillator, coefficients_antialiassing, coefficients_bandpass)
-        method_res_norm = dm.normalize_0_1(method_res)
-        method_times = buf_times
-
-        method = r"\bf{FILTERING}"
+        method = "FILTERING"
         print("Method: FILTERING")
 
+    # Sliding Goertzel
+    elif args.method == 4:
+        method = "SLIDING GOERTZEL"
+        print("Method: SLIDING GOERTZEL")
+        print(f"Center set frequency: {', '.join(str(f) for f in args.goertzel)} Hz ")
+        print(f"Window: {args.buffer} samples, hop: {args.hop} samples")
+
     # Invalid method
     else:
         print("Invalid method")
@@ -101,75 +183,168 @@ def main(args):
     #######################################################
     # THRESHOLD
     #######################################################
+    t0 = perf_counter()
+
+    # Same reference time for every step between values
+    cells = args.buffer*10*args.buffer//step
+    with profiler.stage("cfar", np.shape(method_res_norm)[-1]):
+        threshold, detect = dm.do_cfar_adapt(method_res_norm, args.sampleRate, step, args.pulseWidth, cells, args.cfar, args.rank)
 
-    threshold, detect = dm.do_cfar_adapt(method_res_norm, args.sampleRate, args.buffer, args.pulseWidth, args.buffer*10)
+    timings["threshold"] = perf_counter() - t0
+
+    # Estimated cost on the target
+    if args.verbose and args.method in (1, 2, 3, 4):
+        mcu = dm.pipeline_cost(args.method, args.sampleRate, args.buffer, args.pulseWidth, cells, args.hop,
+                               len(args.goertzel), args.cfar, args.onFreq, args.offFreq, args.filterFrequency,
+                               args.localOscillator, (len(coefficients_antialiassing), len(coefficients_bandpass)))
+        print(f"MCU estimate: {mcu['cycles']:.0f} cycles per value, {100*mcu['load']:.1f} % CPU, "
+              f"{mcu['uj_s']:.0f} uJ/s, {mcu['ram']} B RAM")
 
     #######################################################
     # DETECTION and DDECODE
     #######################################################
+    t0 = perf_counter()
+
+    if detect.ndim == 1:
+        with profiler.stage("pulse", detect.size):
+            detec_pulse, detect_times = dm.do_check_pulse(detect,args.sampleRate,step,args.pulseWidth)
 
-    detec_pulse, detect_times = dm.do_check_pulse(detect,args.sampleRate,args.buffer,args.pulseWidth)
-    pings, decoded = dm.decode_times(detect_times,0.339,dict_vemco)
+    # Array: pulse check per channel, k-of-n vote at the earliest arrival
+    else:
+        with profiler.stage("pulse", detect.size):
+            checks = [dm.do_check_pulse(channel, args.sampleRate, step, args.pulseWidth) for channel in detect]
+            detec_pulse = np.array([check[0] for check in checks])
+        with profiler.stage("fusion", sum(len(check[1]) for check in checks)):
+            detect_times, events = dm.fuse_times([check[1] for check in checks], args.vote, args.coincidence/1000)
+        for channel, check in enumerate(checks):
+            print(f"Channel {channel}: {len(check[1])} pings")
+        print(f"Fused ({args.vote} of {len(checks)}): {len(events)} pings")
+
+    with profiler.stage("decode", len(detect_times)):
+        pings, decoded = dm.decode_times(detect_times,0.339,dict_vemco,args.tolerance/1000)
 
     packet = 20
-    id_pulse, id_times = dm.do_check_pulse_broad(detect, args.sampleRate, args.buffer, packet)
-    correlate, check_times = dm.correlate_id_vemco(id_pulse,packet,[340, 660, 600, 420, 460, 600, 500])
+    id_code = [340, 660, 600, 420, 460, 600, 500]
+    with profiler.stage("correlate", detect.shape[-1]):
+        id_pulse, id_times = dm.do_check_pulse_broad(detect.max(axis=0) if detect.ndim == 2 else detect, args.sampleRate, step, packet)
+        correlate, check_times = dm.correlate_id_vemco(id_pulse,packet,id_code)
+    timings["detect"] = perf_counter() - t0
 
 
     print(f"{pings} pings\nmsg: {decoded}")
+
+    if save_profile:
+        print(profiler.summary())
+        print("Profile: " + ", ".join(profiler.save(args.profile)))
+
+    #######################################################
+    # RESULTS STORE
+    #######################################################
+    if store is not None:
+        info = dict(file=os.path.abspath(args.input), method=args.method, config=dm.config_hash(run_config(args)),
+                    start=dm.recording_start(args.input, samples.shape[-1] / sample_rate))
+        channel = -1 if detect.ndim == 2 else 0  # -1 for the fused array
+
+        if detect.ndim == 2:
+            for c, check in enumerate(checks):
+                store.add_detections("pulse", check[1], channel=c, **info)
+        store.add_detections("pulse", detect_times, channel=channel, **info)
+
+        symbols, symbol_times = dm.symbol_times(detect_times, 0.339, dict_vemco, args.tolerance/1000)
+        store.add_detections("symbol", symbol_times, symbols=symbols, channel=channel, **info)
+
+        # Peaks with most of the ID pulses
+        peak_times, peak_scores = dm.correlation_peaks(correlate, check_times, (len(id_code) + 1) / 2)
+        store.add_detections("peak", peak_times, scores=peak_scores, channel=channel, **info)
+
+        if args.storeSeries and len(method_res_norm):
+            values, thresholds, detects = np.atleast_2d(method_res_norm, threshold, detect)
+            for c in range(len(values)):
+                store.add_series(method_times, values[c], thresholds[c], detects[c], channel=c, **info)
+
+        print(f"Results: {args.store}")
+
     #######################################################
     # PLOT
     #######################################################
-    if args.show:
+    if args.show or args.save:
+        # matplotlib only when plotting, headless runs start faster
+        import matplotlib
+        if not args.show:
+            matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        # LaTeX text if asked for and installed, bold labels otherwise
+        usetex = dm.use_latex(args.latex)
+        bold = (lambda text: rf"\bf{{{text}}}") if usetex else (lambda text: text)
+
+        # Long signals drawn as their min/max envelope, redrawn on zoom. The
+        # plots are kept in variables, the zoom callbacks only hold weak references
+        end = samples.shape[-1] / sample_rate
+        dt = step / args.sampleRate
+        t0 = method_times[0] if len(method_times) else 0
+
         # ADC input
         fig_gnrl, (gnrl) = plt.subplots()
-        gnrl.plot(time_wav, samples)
-        gnrl.set_ylabel(r"\bf{ADC Counts - x(n)}")
-        gnrl.set_xlabel(r"\bf{Time (s)}")
+        signal_plot = dm.plot_envelope(gnrl, samples, 0, 1 / sample_rate)
+        gnrl.set_ylabel(bold("ADC Counts - x(n)"))
+        gnrl.set_xlabel(bold("Time (s)"))
 
         # Detection method
         if args.normalised:
             method_plot = method_res_norm
-            method_units = r"\bf{ - normalised}"
+            method_units = " - normalised"
         else:
             method_plot = method_res
-            method_units = r"\bf{ - Calculation Result}"
+            method_units = " - Calculation Result"
 
-        fig_method, (mth, thr, bro) = plt.subplots(3,1)
+        # Pulses found, where the pulse check gives 1
+        pulse_index = np.nonzero(np.atleast_2d(detec_pulse) > 0)[1]
+        pulse_times = np.asarray(method_times)[pulse_index]
+
+        fig_method, (mth, thr, bro) = plt.subplots(3, 1, sharex=True)
         # # Method result
-        mth.plot(method_times, method_plot, label="Signal Processed")
-        mth.plot(method_times,detec_pulse, "o", label="Pulse detection")
+        method_lines = dm.plot_envelope(mth, method_plot, t0, dt, label="Signal Processed")
+        mth.plot(pulse_times, np.ones(len(pulse_times)), "o", label="Pulse detection")
 
         if args.normalised:
-            mth.plot(method_times, threshold, color="red", alpha = 0.3, label = "CFAR Threshold")
+            method_lines += dm.plot_envelope(mth, threshold, t0, dt, color="red", alpha = 0.3, label = "CFAR Threshold")
             mth.set_ylim(0, 1.5)
-            mth.set_xlim(-1, 31)
             mth.legend(loc="upper right")
 
-        mth.set_ylabel(method + method_units)
+        mth.set_ylabel(bold(method + method_units))
 
         # # Threshold
-        thr.plot(method_times, detect, color="green", label = "Signal detection")
-        thr.plot(method_times,detec_pulse, "o", color = "orange", label="Pulse detection")
+        method_lines += dm.plot_envelope(thr, detect, t0, dt, color="green", label = "Signal detection")
+        thr.plot(pulse_times, np.ones(len(pulse_times)), "o", color = "orange", label="Pulse detection")
 
         thr.set_ylim(0,1.5)
-        thr.set_xlim(-1,31)
 
         thr.legend(loc="upper right")
 
 
-        for i in range(len(id_pulse)):
-            if id_pulse[i]:
-                bro.vlines(id_times[i], 0, max(correlate))
-        bro.plot(check_times, correlate, color = 'r', alpha = 0.7)
+        bro.vlines(np.asarray(id_times)[np.asarray(id_pulse, dtype=bool)], 0, max(correlate, default=0))
+        if len(check_times) > 1:
+            method_lines += dm.plot_envelope(bro, correlate, check_times[0], check_times[1] - check_times[0], color = 'r', alpha = 0.7)
+
+        bro.set_xlim(-1, end + 1)
 
-        bro.set_xlim(-1, 31)
 
+        bro.set_xlabel(bold("Time (s)"))
+
+        # PNG files for headless and batch runs
+        if args.save:
+            os.makedirs(args.save, exist_ok=True)
+            name = os.path.join(args.save, os.path.splitext(os.path.basename(args.input))[0])
+            fig_gnrl.savefig(name + "_signal.png", dpi=150)
+            fig_method.savefig(name + "_detection.png", dpi=150)
+            print(f"Plots: {name}_signal.png, {name}_detection.png")
 
-        bro.set_xlabel(r"\bf{Time (s)}")
         # PLT SHOW
-        plt.show()
-    else: pass
+        if args.show:
+            plt.show()
+        plt.close(fig_gnrl)
+        plt.close(fig_method)
 
     #######################################################
     # OUTPUT LOG FILE
@@ -180,7 +355,32 @@ def main(args):
     return pings, decoded
 
 
-if __name__ == "__main__":
+def method_params(args):
+
+    """
+    Parameters the method output depends on: the method, the filter
+    coefficients and, for a CSV capture, the columns read
+    """
+
+    params = dm.method_key(args, (coefficients_antialiassing, coefficients_bandpass))
+    if args.input.lower().endswith(".csv"):
+        params += (tuple(args.csvColumn), args.csvTime or None)
+
+    return params
+
+
+def run_config(args):
+
+    """
+    Parameters the detections depend on, hashed in the results store
+    """
+
+    return {"method": method_params(args), "goertzel": args.goertzel, "hop": args.hop,
+            "filter": [args.filterFrequency, args.localOscillator],
+            "detect": [args.pulseWidth, args.tolerance, args.cfar, args.rank, args.vote, args.coincidence]}
+
+
+def build_argparser():
 
     # INIT
     argparser = ArgumentParser()
@@ -189,20 +389,26 @@ if __name__ == "__main__":
     argparser.add_argument("-v", "--verbose", help="more info", action="store_true")
 
     # INPUT
-    argparser.add_argument("-i", "--input", help="Input file directory and name, default docs/1.wav", type=str, default="docs/1.wav")
+    argparser.add_argument("-i", "--input", help="Input WAV file or logic-analyzer CSV capture, default docs/1.wav", type=str, default="docs/1.wav")
+    argparser.add_argument("-cy", "--csvColumn", help="CSV capture data column, several for an array, default Data", type=str, nargs="+", default=["Data"])
+    argparser.add_argument("-cx", "--csvTime", help="CSV capture time column in s, gives the sample rate, default Time(s)", type=str, default="Time(s)")
+    argparser.add_argument("-bl", "--block", help="WAV samples read per block, default 1048576", type=int, default=1048576)
 
     # ACQUISITION
     argparser.add_argument("-sr", "--sampleRate", help="Sample Rate of the uC, default 150000 S/s", type=int, default=150000)
     argparser.add_argument("-b", "--buffer", help="ADC Buffer lenght, default = 256", type=int, default=256)
 
     # PROCESSING
-    argparser.add_argument("-m", "--method", help="Processing method, 1: FFT, 2: Go, 3: Filt, default = 1", type = int, default=1)
+    argparser.add_argument("-m", "--method", help="Processing method, 1: FFT, 2: Go, 3: Filt, 4: Sliding Go, default = 1", type = int, default=1)
 
     # CONFIG METHODS
-    argparser.add_argument("-g", "--goertzel", help="Goertzel method, center frequency, default = 69000", type=int, default=69000)
+    argparser.add_argument("-nf", "--numeric", help="Numeric format of methods 1-3, float64, float32, q15 or q31, default float64", type=str, choices=dm.FORMATS, default="float64")
+    argparser.add_argument("-hop", "--hop", help="Sliding Goertzel hop in samples (1 to buffer), default = 64", type=int, default=64)
+    argparser.add_argument("-g", "--goertzel", help="Goertzel method, center frequency (several to scan channels, the max power is kept), default = 69000", type=int, nargs="+", default=[69000])
 
     argparser.add_argument("-on", "--onFreq", help="Bandpass on frequency in Hz, default 68000 Hz", type=int, default = 68000)
     argparser.add_argument("-off", "--offFreq", help="Bandpass off frequency in Hz, default 70000 Hz", type=int, default=70000)
+    argparser.add_argument("-fw", "--fftWorkers", help="FFT threads, -1 all cores, default 1", type=int, default=1)
 
     argparser.add_argument("-ffreq", "--filterFrequency", help="center signal frequency", type=int, default=69000)
     argparser.add_argument("-LO", "--localOscillator", help="Local Oscillator, default 58000", type=int, default=58000)
@@ -210,14 +416,40 @@ if __name__ == "__main__":
     # DETECTION
 
     argparser.add_argument("-p", "--pulseWidth", help="Pulse Width, default 5 ms", type=int, default=5)
+    argparser.add_argument("-tol", "--tolerance", help="Decode tolerance around each code, default 5 ms", type=float, default=5)
+    argparser.add_argument("-c", "--cfar", help="CFAR noise estimate, ca: average, go: greatest of, so: smallest of, os: order statistic, default ca", type=str, choices=["ca", "go", "so", "os"], default="ca")
+    argparser.add_argument("-r", "--rank", help="OS-CFAR order statistic, 0 min to 1 max, default 0.75", type=float, default=0.75)
+
+    # ARRAY
+    argparser.add_argument("-k", "--vote", help="Channels that must detect a pulse (k of n), default 1", type=int, default=1)
+    argparser.add_argument("-cw", "--coincidence", help="Max spread of a pulse across the channels, default 10 ms", type=float, default=10)
+
+    # CACHE
+    argparser.add_argument("-ca", "--cache", help="Folder to cache the method output, default no cache", type=str, default="")
+    argparser.add_argument("-cs", "--cacheSize", help="Cache size cap in MB, default 2048", type=int, default=2048)
+
+    # PROFILING
+    argparser.add_argument("-pf", "--profile", help="Stage profile, writes PREFIX.json and the Chrome trace PREFIX.trace.json, default none", type=str, default="")
+    argparser.add_argument("-pm", "--profileMemory", help="Peak memory per stage with tracemalloc (slower), 1 yes 0 no, default 0", type=int, default=0)
+
+    # RESULTS STORE
+    argparser.add_argument("-st", "--store", help="Results store folder, Parquet datasets (needs pyarrow), default none", type=str, default="")
+    argparser.add_argument("-ss", "--storeSeries", help="Also store the method, threshold and detection series, 1 yes 0 no, default 0", type=int, default=0)
 
     # OUTPUT
     argparser.add_argument("-sw", "--show", help="show plot default YES (1)", type=int,default=1)
+    argparser.add_argument("-sv", "--save", help="Folder to save the plots as PNG, also without --show, default none", type=str, default="")
+    argparser.add_argument("-tex", "--latex", help="LaTeX text in the plots (slower, needs LaTeX), 1 yes 0 no, default 0", type=int, default=0)
     argparser.add_argument("-n", "--normalised", help="Output plot, 1 Normalised, 0 not normalised", type=int, default=1)
     argparser.add_argument("-o", "--output", help="0 if no output, 1 if log.txt", type=int, default=0)
 
+    return argparser
+
+
+if __name__ == "__main__":
+
     # EXIT
-    args = argparser.parse_args()
+    args = build_argparser().parse_args()
 
     try:
         decoded = []
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time detector: raw int16 samples from stdin, a UNIX domain socket or a
+shared-memory ring, detections, decoded IDs and metrics as JSON lines. With
+one UNIX socket per hydrophone the channels are fused (k of n).
+
+With --play it is the producer instead: a WAV file sent at wall-clock rate,
+to test the detector without the ADC, e.g.
+
+    python realtime.py -pl docs/1.wav | python realtime.py -i stdin -fs 500000
+    python realtime.py -i unix:/tmp/h0 unix:/tmp/h1 -k 2 &
+    python realtime.py -pl array.wav -i unix:/tmp/h0 unix:/tmp/h1
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+# IMPORTS
+import sys
+import time
+import socket
+from argparse import ArgumentParser
+
+import numpy as np
+
+import demlib as dm
+from docs.filter_coefficients import coefficients_antialiassing, coefficients_bandpass
+from docs.decode_lists import dict_vemco
+from main import build_argparser
+
+
+#######################################################
+# PIPELINE
+#######################################################
+
+def build_detector(args, source):
+
+    """
+    LiveDetector with the main.py pipeline for args.method
+    """
+
+    fmt = args.numeric
+    profiler = dm.Profiler(args.profileMemory) if args.profile else dm.NULL_PROFILER
+
+    if args.method == 4:
+        frontend = lambda blocks: dm.do_sdft_blocks(blocks, args.sampleRate, args.goertzel, args.buffer, args.hop)
+        method = lambda power: power.max(axis=-1)
+        step = args.hop
+    else:
+        frontend = lambda blocks: dm.do_buffers_blocks(blocks, args.buffer, args.sampleRate)
+        step = args.buffer
+
+        if args.method == 1:
+            method = lambda b: dm.do_fft(b, args.sampleRate, args.onFreq, args.offFreq, fmt=fmt)[0]
+        elif args.method == 2:
+            method = lambda b: dm.do_goertzel(b, args.sampleRate, args.goertzel, fmt=fmt).max(axis=-1)
+        elif args.method == 3:
+            state = {}  # LO phase and FIR memory carried between buffers
+            method = lambda b: dm.do_filter(b, args.sampleRate, args.filterFrequency, args.localOscillator,
+                                            coefficients_antialiassing, coefficients_bandpass, state=state, fmt=fmt)
+        else:
+            raise ValueError(f"Invalid method {args.method}")
+
+    # Bounds of the recording unknown, fixed ones if given or settle them in the warm-up
+    if args.normLow is not None and args.normHigh is not None:
+        normalize = dm.NormalizeStage(args.normLow, args.normHigh)
+    else:
+        normalize = dm.RunningNormalizeStage(int(args.warmup * args.sampleRate / step))
+
+    cells = args.buffer*10*args.buffer//step if args.cells is None else args.cells
+    cfar = dm.CfarStage(args.sampleRate, step, args.pulseWidth, cells, mode=args.cfar, rank=args.rank)
+    decode = dm.DecodeStage(0.339, dict_vemco, args.tolerance/1000)
+
+    # One pulse check per hydrophone, fused before the decode
+    channels = len(args.input)
+    if channels > 1:
+        engine = dm.ArrayEngine(method, normalize, cfar,
+                                [dm.PulseStage(args.sampleRate, step, args.pulseWidth) for _ in range(channels)],
+                                dm.FusionStage(channels, args.vote, args.coincidence/1000), decode, profiler)
+    else:
+        engine = dm.StreamEngine(method, normalize, cfar, dm.PulseStage(args.sampleRate, step, args.pulseWidth), decode,
+                                 profiler)
+
+    return dm.LiveDetector(source, engine, args.inputRate, args.sampleRate, frontend, step, args.chunk, args.queue,
+                           args.overflow, args.metrics, profiler=profiler)
+
+
+#######################################################
+# PLAYER
+#######################################################
+
+def play(args):
+
+    """
+    Send a WAV file to args.input at args.speed times the wall-clock rate
+    """
+
+    sample_rate, samples = dm.open_wav(args.play)
+    samples = np.atleast_2d(samples.astype("<i2", copy=False).T)  # (channels, n_samples)
+    print(f"Playing {args.play} at {sample_rate} S/s to {' '.join(args.input)}", file=sys.stderr)
+
+    if len(samples) != len(args.input):
+        raise ValueError(f"{len(samples)} channels in the file, give one output per channel")
+
+    ring = None
+    conns = []
+    output = args.input[0]
+    if output in ("stdin", "-"):
+        write = lambda block: sys.stdout.buffer.write(block[0].tobytes())
+    elif all(path.startswith("unix:") for path in args.input):
+        for path in args.input:
+            conns.append(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            conns[-1].connect(path[5:])
+
+        # Channel by channel, the receiver reads them concurrently
+        def write(block):
+            for conn, channel in zip(conns, block):
+                conn.sendall(channel.tobytes())
+    elif output.startswith("ring:"):
+        ring = dm.SharedRing(output[5:], max(args.chunk, int(sample_rate)), create=True)
+        while ring.reader < 0:  # Readers start at the present, wait for one
+            time.sleep(0.01)
+        write = lambda block: ring.write(block[0])
+    else:
+        raise ValueError(f"Unknown output {output}, use stdin, unix:PATH or ring:NAME")
+
+    start = time.perf_counter()
+    try:
+        for offset, block in dm.iter_blocks(samples, args.chunk):
+            ahead = offset / (sample_rate * args.speed) - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+            write(block)
+
+    finally:
+        if ring:
+            ring.close()
+            while 0 <= ring.reader < samples.shape[-1]:  # Do not unlink under the reader
+                time.sleep(0.01)
+            ring.release()
+        for conn in conns:
+            conn.close()
+        if not ring and not conns:
+            sys.stdout.buffer.flush()
+
+
+# MAIN
+
+def main(args):
+    if args.play:
+        return play(args)
+
+    detector = build_detector(args, dm.open_source(args.input))
+    stats = detector.run()
+
+    # stdout holds the JSON lines
+    if args.profile:
+        print(detector.profiler.summary(), file=sys.stderr)
+        print("Profile: " + ", ".join(detector.profiler.save(args.profile)), file=sys.stderr)
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    # INIT, pipeline options as main.py
+    argparser = ArgumentParser(parents=[build_argparser()], conflict_handler="resolve")
+
+    # SOURCE
+    argparser.add_argument("-i", "--input", help="Sample source, stdin, unix:PATH or ring:NAME, or one unix:PATH per hydrophone, default stdin", type=str, nargs="+", default=["stdin"])
+    argparser.add_argument("-fs", "--inputRate", help="Sample rate of the source, default 1000000 S/s", type=int, default=1000000)
+    argparser.add_argument("-ch", "--chunk", help="Samples per read, default 4096", type=int, default=4096)
+
+    # LATENCY
+    argparser.add_argument("-q", "--queue", help="Chunks waiting to be processed, default 64", type=int, default=64)
+    argparser.add_argument("-ov", "--overflow", help="Queue full, block: wait for the detector, drop: drop the chunk, default block", type=str, choices=["block", "drop"], default="block")
+    argparser.add_argument("-ce", "--cells", help="CFAR cells, default as main.py", type=int, default=None)
+
+    # NORMALISATION
+    argparser.add_argument("-nl", "--normLow", help="Method value mapped to 0, default running min", type=float, default=None)
+    argparser.add_argument("-nh", "--normHigh", help="Method value mapped to 1, default running max", type=float, default=None)
+    argparser.add_argument("-wu", "--warmup", help="Signal held to settle the running min/max, default 2 s", type=float, default=2)
+
+    # OUTPUT
+    argparser.add_argument("-me", "--metrics", help="Seconds of signal between metrics lines, 0 none, default 1", type=float, default=1)
+
+    # PLAYER
+    argparser.add_argument("-pl", "--play", help="WAV file to send to --input instead of detecting, default none", type=str, default="")
+    argparser.add_argument("-sp", "--speed", help="Player speed, 1 wall-clock rate, default 1", type=float, default=1)
+
+    # EXIT
+    args = argparser.parse_args()
+
+    try:
+        main(args)
+
+    except (KeyboardInterrupt, BrokenPipeError):
+        print("Program terminated by user.", file=sys.stderr)
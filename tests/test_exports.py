@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy exports of demlib: every name of dir(demlib) is the object the star
+imports of the submodules gave (in order, the last one wins), and the name
+table lists every public name each submodule defines.
+
+    python -m pytest tests
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import ast
+import sys
+from importlib import import_module
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import demlib as dm
+
+
+def defined(module):
+    # Public names bound at the top level of the submodule source, imports aside
+    with open(os.path.join(ROOT, "demlib", f"{module}.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    names = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            for target in node.targets if isinstance(node, ast.Assign) else [node.target]:
+                names.update(n.id for n in ast.walk(target) if isinstance(n, ast.Name))
+    return {name for name in names if not name.startswith("_")}
+
+
+def test_table_covers_submodules():
+    for module in dm._SUBMODULES:
+        assert set(dm._EXPORTS[module]) == defined(module), module
+
+
+def test_same_objects_as_star_imports():
+    star = {}
+    for module in dm._SUBMODULES:
+        exec(f"from demlib.{module} import *", star)
+
+    for name in dir(dm):
+        if name.startswith("_") or name in dm._SUBMODULES:
+            continue
+        assert getattr(dm, name) is star[name], name
+
+
+def test_submodules():
+    for module in dm._SUBMODULES:
+        assert getattr(dm, module) is import_module(f"demlib.{module}")
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Cold-start budget: main.py on a short synthetic recording in a fresh
+interpreter, headless. The run must not load scipy.signal nor matplotlib.
+Its wall time, interpreter start and DSP included, only has a loose bound
+to catch gross regressions, set COLD_START_BUDGET_S to change it (0 none).
+The strict import times are those of import_budget.py, checked too.
+
+    python -m pytest tests
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import sys
+import json
+import wave
+import subprocess
+from time import perf_counter
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import demlib as dm
+import import_budget
+from docs.decode_lists import dict_vemco
+
+RUN_BUDGET_S = float(os.environ.get("COLD_START_BUDGET_S", 20.0))  # Wall time of the whole run, 0 none
+FORBIDDEN = ("scipy.signal", "matplotlib")
+
+# Runs main.py as the command line does, then reports the forbidden modules loaded
+RUN = f"""
+import sys, json, runpy
+sys.argv = ["main.py", "-i", sys.argv[1], "-sw", "0"]
+runpy.run_path("main.py", run_name="__main__")
+print(json.dumps([m for m in sys.modules if any(m == f or m.startswith(f + ".") for f in {FORBIDDEN!r})]))
+"""
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    sample_rate, duration = 600000, 3.0
+    ends = dm.ppm_train([395, 415, 435], dict_vemco, duration, start=0.5)
+    samples = dm.synth_ppm(sample_rate, ends, 10, duration, seed=1)
+
+    path = str(tmp_path_factory.mktemp("cold_start") / "short.wav")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype("<i2").tobytes())
+
+    return path
+
+
+def test_cold_start(recording):
+    t0 = perf_counter()
+    run = subprocess.run([sys.executable, "-c", RUN, recording], cwd=ROOT, capture_output=True, text=True,
+                         timeout=60)
+    seconds = perf_counter() - t0
+    assert run.returncode == 0, run.stderr
+
+    loaded = json.loads(run.stdout.splitlines()[-1])
+    assert not loaded, f"a headless run loads {sorted(set(loaded))}"
+    assert "msg: ['init', 395, 415, 435]" in run.stdout
+    assert not RUN_BUDGET_S or seconds < RUN_BUDGET_S, f"cold start {seconds:.2f} s over {RUN_BUDGET_S} s"
+
+
+def test_import_budget():
+    targets = [("demlib", 50.0), ("main", 400.0), ("realtime", 400.0)]
+    assert import_budget.check(targets, 3, ["scipy", "matplotlib"], 10)
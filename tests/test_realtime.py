@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time detector: a synthetic two-hydrophone recording played to
+realtime.py over one UNIX socket per channel, fused with -k 2, and a
+source that fails while it is read.
+
+    python -m pytest tests
+
+Author: Gerard Batet
+Institution: Universitat Politècnica de Catalunya (UPC)
+email: gerard.batet@upc.edu
+"""
+
+import os
+import sys
+import json
+import time
+import wave
+import subprocess
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import demlib as dm
+from main import build_argparser
+from realtime import build_detector
+from docs.decode_lists import dict_vemco
+
+SAMPLE_RATE = 600000
+DECIMATION = 4  # 600 kS/s to the 150 kS/s of the uC
+BUFFER = 256
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    duration = 3.0
+    ends = dm.ppm_train([395, 415, 435], dict_vemco, duration, start=0.5)
+    samples = np.stack([dm.synth_ppm(SAMPLE_RATE, ends, 10, duration, seed=seed) for seed in (1, 2)], axis=1)
+
+    path = str(tmp_path_factory.mktemp("realtime") / "array.wav")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(samples.astype("<i2").tobytes())
+
+    return path, samples.shape[0]
+
+
+def test_array_vote(recording, tmp_path):
+    path, n_samples = recording
+    sockets = [f"unix:{tmp_path / f'h{c}'}" for c in range(2)]
+
+    detector = subprocess.Popen([sys.executable, "realtime.py", "-i", *sockets, "-k", "2", "-fs", str(SAMPLE_RATE),
+                                 "-me", "0"], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        deadline = time.monotonic() + 30
+        while not all(os.path.exists(s[5:]) for s in sockets):
+            assert detector.poll() is None, detector.stderr.read()
+            assert time.monotonic() < deadline, "the detector did not open its sockets"
+            time.sleep(0.05)
+
+        player = subprocess.run([sys.executable, "realtime.py", "-pl", path, "-i", *sockets, "-sp", "100"], cwd=ROOT,
+                                capture_output=True, text=True, timeout=60)
+        assert player.returncode == 0, player.stderr
+        out, err = detector.communicate(timeout=60)
+    finally:
+        detector.kill()
+
+    assert detector.returncode == 0, err
+    events = [json.loads(line) for line in out.splitlines()]
+    decoded = [event["symbols"] for event in events if event["event"] == "decode"]
+    stats = events[-1]
+
+    assert ["init", 395, 415, 435] in decoded
+    assert stats["event"] == "metrics"
+    assert stats["samples"] == n_samples
+    # Envelope values of one channel, not the number of channels
+    assert stats["values"] == -(-n_samples // (DECIMATION * BUFFER))
+
+
+class FailingSource:
+
+    """
+    Source that gives `chunks` chunks of silence and then raises
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def read(self, n):
+        if not self.chunks:
+            raise OSError("connection reset")
+        self.chunks -= 1
+        return np.zeros(n, dtype="<i2"), 0
+
+    def close(self):
+        self.closed = True
+
+
+def test_source_error():
+    args = build_argparser().parse_args([])
+    vars(args).update(input=["stdin"], inputRate=SAMPLE_RATE, chunk=4096, queue=64, overflow="block", cells=None,
+                      normLow=None, normHigh=None, warmup=2, metrics=0)
+    source = FailingSource(10)
+
+    with open(os.devnull, "w") as out:
+        detector = build_detector(args, source)
+        detector.out = out
+        with pytest.raises(OSError, match="connection reset"):
+            detector.run()
+
+    assert source.closed